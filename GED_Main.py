@@ -34,49 +34,176 @@ else:
 # importing required libraries and modules
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, AdamW, get_linear_schedule_with_warmup
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
-from sklearn.metrics import confusion_matrix, f1_score, precision_score
+from sklearn.metrics import confusion_matrix, f1_score
 from tqdm import tqdm
+from functools import cached_property, partial
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import collections
+import json
+import numpy as np
+import time
+# the model, tokenization, profiling, inference and serving code shared with the serving processes lives in ged_inference.py
+from ged_inference import (device, stage_profiler, PeakMemoryMonitor, LengthBucketSampler, RaggedTokenIds, get_tokenizer, pad_collate,
+                           init_tokenizer_worker, tokenize_chunk, tokenize_windows, num_classes, DebertaClassifier,
+                           predict_proba_batched, GrammarErrorDetector, benchmark_detector, score_file_sharded)
+
+# defining a dataset over variable-length (unpadded) token sequences
+class _VariableLengthDataset(torch.utils.data.Dataset):
+    def __init__(self, input_ids, labels, with_labels=True):
+        self.input_ids = input_ids
+        self.labels = labels
+        self.with_labels = with_labels
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, index):
+        # return the token ids, the label (if any) and the original position of the sentence
+        if self.with_labels:
+            return self.input_ids[index], self.labels[index], index
+        return self.input_ids[index], index
+
+
+# method to tokenize sentences chunk by chunk, writing the flat token ids straight to a file
+def tokenize_to_files(sentences, tokenizer, tokenizer_name, max_length, token_ids_path, chunk_size=10000, num_proc=1):
+    chunks = (sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size))
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    position = 0
+
+    # tokenize in worker processes for large corpora, otherwise in this process
+    if num_proc > 1:
+        pool = multiprocessing.Pool(num_proc, initializer=init_tokenizer_worker, initargs=(tokenizer_name,))
+        results = pool.imap(partial(tokenize_chunk, max_length=max_length), chunks)
+    else:
+        pool = None
+        results = (tokenize_chunk(chunk, max_length, tokenizer=tokenizer) for chunk in chunks)
+
+    try:
+        with open(token_ids_path, 'wb') as f:
+            for token_ids, lengths in results:
+                f.write(token_ids.tobytes())
+                offsets[position + 1:position + 1 + len(lengths)] = offsets[position] + np.cumsum(lengths)
+                position += len(lengths)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return offsets
+
+# method to compute the cache key of a corpus for a given tokenizer and max_length
+def token_cache_key(sentences, tokenizer_name, max_length):
+    digest = hashlib.sha256(f"{tokenizer_name}\0{max_length}\0".encode('utf-8'))
+    for sent in sentences:
+        digest.update(str(sent).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# method to tokenize sentences, reusing memory-mapped results from cache_dir when available
+def load_or_tokenize(sentences, tokenizer, tokenizer_name, max_length=128, cache_dir=None, num_proc=1):
+    sentences = [str(sent) for sent in sentences]
+
+    # without a cache, tokenize into a temporary file and keep the arrays in memory
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            token_ids_path = os.path.join(tmp_dir, 'input_ids.bin')
+            offsets = tokenize_to_files(sentences, tokenizer, tokenizer_name, max_length, token_ids_path, num_proc=num_proc)
+            token_ids = np.fromfile(token_ids_path, dtype=np.int32)
+        return RaggedTokenIds(token_ids, offsets)
+
+    entry_dir = os.path.join(cache_dir, token_cache_key(sentences, tokenizer_name, max_length))
+    token_ids_path = os.path.join(entry_dir, 'input_ids.bin')
+    offsets_path = os.path.join(entry_dir, 'offsets.npy')
+
+    if not os.path.exists(offsets_path):
+        # build the entry in a temporary directory and move it into place once complete
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            offsets = tokenize_to_files(sentences, tokenizer, tokenizer_name, max_length, os.path.join(tmp_dir, 'input_ids.bin'), num_proc=num_proc)
+            np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # another process has already written the same entry
+            if not os.path.exists(offsets_path):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    offsets = np.load(offsets_path, mmap_mode='r')
+    # np.memmap cannot map an empty file
+    if offsets[-1] == 0:
+        token_ids = np.zeros(0, dtype=np.int32)
+    else:
+        token_ids = np.memmap(token_ids_path, dtype=np.int32, mode='r')
+    return RaggedTokenIds(token_ids, offsets)
+
 
 # defining the class for DebertaDataset
 class DebertaDataset:
-    def __init__(self, sentences, labels=None, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16):
-        # instantiating a tokenizer object
-        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    def __init__(self, sentences, labels=None, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, max_length=128, dynamic_padding=True, cache_dir=None, num_proc=1,
+                 num_workers=0, pin_memory=False, prefetch_factor=2, persistent_workers=False):
+        # getting the tokenizer shared by all datasets of this process
+        self.tokenizer = get_tokenizer(tokenizer_name)
+        self.tokenizer_name = tokenizer_name
         self.batch_size = batch_size
+        self.max_length = max_length
+        # pad each batch to its longest sentence instead of to max_length
+        self.dynamic_padding = dynamic_padding
+        # directory of the on-disk token cache (None disables it) and number of tokenization processes
+        self.cache_dir = cache_dir
+        self.num_proc = num_proc
+        # dataloader worker processes, pinned host memory for faster copies to the GPU, and batches prefetched per worker
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
         
         # creating input ids, attention masks and labels for the given sentences
         self.input_ids, self.attention_masks, self.labels = self._prepare_data(sentences, labels)
         
-        # creating dataloaders for training, validation and testing
-        self.train_dataloader = self._create_train_dataloader()
-        self.val_dataloader = self._create_val_dataloader()
-        self.test_dataloader = self._create_test_dataloader()
+
+    # dataloaders for training, validation and testing, each created on first access
+    @cached_property
+    def train_dataloader(self):
+        return self._create_train_dataloader()
+
+    @cached_property
+    def val_dataloader(self):
+        return self._create_val_dataloader()
+
+    @cached_property
+    def test_dataloader(self):
+        return self._create_test_dataloader()
+
+    # dataset of input ids, attention masks and labels shared by the fixed-length train and validation dataloaders
+    @cached_property
+    def _labeled_tensor_dataset(self):
+        return TensorDataset(self.input_ids, self.attention_masks, self.labels)
 
     # method to prepare data for DebertaClassifier
     def _prepare_data(self, sentences, labels):
-        input_ids = []
-        attention_masks = []
-        
         # convert labels into tensor objects, if not None
         if labels is not None:
             labels = torch.tensor(labels)
 
-        # loop through the sentences, tokenize and create input ids, attention masks
-        for sent in sentences:
-            encoded_dict = self.tokenizer.encode_plus(
-                sent,                      # Sentence to encode.
-                add_special_tokens=True,   # Add '[CLS]' and '[SEP]'
-                max_length=128,           # Pad & truncate all sentences.
-                pad_to_max_length=True,
-                return_attention_mask=True,   # Construct attn. masks.
-                return_tensors='pt',     # Return pytorch tensors.
-            )
-            input_ids.append(encoded_dict['input_ids'])
-            attention_masks.append(encoded_dict['attention_mask'])
-
-        # concatenate the list of input ids and attention masks into tensors
-        input_ids = torch.cat(input_ids, dim=0)
-        attention_masks = torch.cat(attention_masks, dim=0)
+        # tokenize all sentences in batches (or load them from the token cache) without padding
+        with stage_profiler.stage('tokenize'):
+            input_ids = load_or_tokenize(sentences, self.tokenizer, self.tokenizer_name, max_length=self.max_length,
+                                         cache_dir=self.cache_dir, num_proc=self.num_proc)
+        stage_profiler.count('sentences_tokenized', len(input_ids))
+        attention_masks = None
+
+        # keep the token lengths, which are used to bucket the sentences
+        self.lengths = input_ids.lengths()
+
+        # padding is done per batch by pad_collate, unless every sentence is padded to max_length
+        if not self.dynamic_padding:
+            input_ids, attention_masks = input_ids.to_padded(self.max_length, pad_token_id=self.tokenizer.pad_token_id or 0)
         
         # create a tensor object for labels, if None
         if labels is None:
@@ -84,43 +211,79 @@ class DebertaDataset:
 
         return input_ids, attention_masks, labels
 
+    # method to get the worker, pinning and prefetching options shared by all dataloaders
+    def _loader_options(self):
+        options = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        # prefetching and persistent workers only apply to worker processes
+        if self.num_workers > 0:
+            options['prefetch_factor'] = self.prefetch_factor
+            options['persistent_workers'] = self.persistent_workers
+        return options
+
+    # method to create a length-bucketed dataloader with per-batch padding
+    def _create_bucketed_dataloader(self, shuffle, with_labels):
+        dataset = _VariableLengthDataset(self.input_ids, self.labels, with_labels=with_labels)
+        pad_token_id = self.tokenizer.pad_token_id or 0
+
+        dataloader = DataLoader(
+            dataset,  # The samples.
+            batch_sampler=LengthBucketSampler(self.lengths, self.batch_size, shuffle=shuffle), # Group similar lengths
+            collate_fn=partial(pad_collate, pad_token_id=pad_token_id), # Pad to the longest in batch
+            **self._loader_options()
+        )
+
+        return dataloader
+
     # method to create dataloader for training
     def _create_train_dataloader(self):
-        # create dataset from input ids, attention masks and labels
-        dataset = TensorDataset(self.input_ids, self.attention_masks, self.labels)
+        if self.dynamic_padding:
+            return self._create_bucketed_dataloader(shuffle=True, with_labels=True)
+
+        # use the dataset of input ids, attention masks and labels
+        dataset = self._labeled_tensor_dataset
 
         # create dataloader with random sampler
         dataloader = DataLoader(
             dataset,  # The samples.
             sampler=RandomSampler(dataset), # Select batches randomly
-            batch_size=self.batch_size # Trains with this batch size.
+            batch_size=self.batch_size, # Trains with this batch size.
+            **self._loader_options()
         )
 
         return dataloader
     
     # method to create dataloader for validation
     def _create_val_dataloader(self):
-        # create dataset from input ids, attention masks and labels
-        dataset = TensorDataset(self.input_ids, self.attention_masks, self.labels)
+        if self.dynamic_padding:
+            return self._create_bucketed_dataloader(shuffle=False, with_labels=True)
+
+        # use the dataset of input ids, attention masks and labels
+        dataset = self._labeled_tensor_dataset
 
         # create dataloader with sequential sampler
         dataloader = DataLoader(
             dataset,  # The samples.
             sampler=SequentialSampler(dataset), # Select batches sequentially
-            batch_size=self.batch_size # Validates with this batch size.
+            batch_size=self.batch_size, # Validates with this batch size.
+            **self._loader_options()
         )
 
         return dataloader
     
     # method to create dataloader for testing
     def _create_test_dataloader(self):
+        if self.dynamic_padding:
+            # batches also carry the original sentence positions to restore the order
+            return self._create_bucketed_dataloader(shuffle=False, with_labels=False)
+
         # create dataset from input ids and attention masks
         dataset = TensorDataset(self.input_ids, self.attention_masks)
 
         dataloader = DataLoader(
             dataset,  # The samples.
             sampler=SequentialSampler(dataset), # Select batches sequentially
-            batch_size=self.batch_size # Tests with this batch size.
+            batch_size=self.batch_size, # Tests with this batch size.
+            **self._loader_options()
         )
 
         return dataloader
@@ -137,76 +300,127 @@ class DebertaDataset:
 
 """# DeBERTaV3 + CNN Classifier Model"""
 
-import torch.nn as nn
-from transformers import AutoModel
-
-num_classes = 2
-
-# Define a class DebertaClassifier that inherits from nn.Module
-class DebertaClassifier(nn.Module):
-    # Constructor method for the DebertaClassifier class
-    def __init__(self, num_classes):
-        # Call the constructor of the superclass (nn.Module)
-        super(DebertaClassifier, self).__init__()
-        # Load the pre-trained DeBERTa model
-        self.deberta = AutoModel.from_pretrained('yevheniimaslov/deberta-v3-base-cola')
-        # Define a dropout layer with 10% dropout probability
-        self.dropout = nn.Dropout(0.1)
-        # Define a 1D convolutional layer with 768 input channels, 256 output channels, and kernel size 3
-        self.conv1d = nn.Conv1d(in_channels=768, out_channels=256, kernel_size=3, padding=1)        
-        # Define a ReLU activation function
-        self.relu = nn.ReLU()
-        # Define an adaptive max pooling layer with output size 1
-        self.pooling = nn.AdaptiveMaxPool1d(1)
-        # Define a fully connected (linear) layer with 256 input features and num_classes output features
-        self.fc1 = nn.Linear(256, num_classes)
-        # Define a softmax activation function
-        self.softmax = nn.Softmax(dim=1)
-        
-    # Define the forward method for the DebertaClassifier class
-    def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None):
-        # Pass the input through the DeBERTa model and obtain the last hidden state
-        outputs = self.deberta(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        last_hidden_state = outputs.last_hidden_state
-        # Transpose the last hidden state so that the channels dimension comes second
-        last_hidden_state = last_hidden_state.transpose(1,2)
-        # Apply dropout to the last hidden state
-        x = self.dropout(last_hidden_state)
-        # Apply the 1D convolutional layer to the last hidden state
-        x = self.conv1d(x)
-        # Apply the ReLU activation function to the output of the convolutional layer
-        x = self.relu(x)
-        # Apply the adaptive max pooling layer to the output of the ReLU activation function
-        x = self.pooling(x).squeeze()
-        # Apply the fully connected layer to the output of the adaptive max pooling layer
-        x = self.fc1(x)
-        # Apply the softmax activation function to the output of the fully connected layer
-        x = self.softmax(x)
-        # Create a tuple of outputs containing the predicted class probabilities
-        outputs = (x,)
-        # If labels are provided, calculate the cross-entropy loss and add it to the outputs tuple
-        if labels is not None:
-            loss_fct = nn.CrossEntropyLoss()
-            loss = loss_fct(x.view(-1, num_classes), labels.view(-1))
-            outputs = (loss,) + outputs
-        
-        return outputs
+# the classifier (DebertaClassifier and num_classes) is defined in ged_inference.py, so that serving processes can load it
+# without this training script; it was imported from there in the first section
 
 """# Training Validation and Testing"""
 
 # Import necessary libraries
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, AdamW, get_linear_schedule_with_warmup
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
-from sklearn.metrics import confusion_matrix, f1_score, precision_score
 from tqdm import tqdm
 import csv
+import math
+import queue
+import threading
+import time
+
+# defining a wrapper that loads and copies the next batches to the device in a background thread
+class BackgroundPrefetcher:
+    def __init__(self, dataloader, device=device, depth=2):
+        self.dataloader = dataloader
+        self.device = device
+        # number of batches kept ready ahead of the one being processed
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # give up when the consumer has stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.dataloader:
+                    batch = tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+                    if not put(batch):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+# defining an on-device accumulator of the loss and the confusion matrix, reduced once per epoch
+class MetricsAccumulator:
+    def __init__(self, num_classes=2, device=device):
+        self.num_classes = num_classes
+        # rows are the true labels and columns the predicted labels, as in sklearn's confusion_matrix
+        self.matrix = torch.zeros((num_classes, num_classes), dtype=torch.long, device=device)
+        # the sentence cross-entropy is kept apart from the training objective, which also holds the token head loss if any
+        self.loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.total_loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.num_samples = 0
+
+    # method to add one batch without synchronizing with the device
+    def update(self, loss, probabilities, labels):
+        predictions = probabilities.argmax(dim=1)
+        # index_add_ has a fixed output size, unlike bincount, which reads the largest index back to the host
+        self.matrix.view(-1).index_add_(0, labels * self.num_classes + predictions, torch.ones_like(labels))
+        # the same cross-entropy as DebertaClassifier computes on the class probabilities it outputs
+        self.loss_sum += torch.nn.functional.cross_entropy(probabilities.detach().float(), labels, reduction='sum')
+        self.total_loss_sum += loss.detach().float() * len(labels)
+        self.num_samples += len(labels)
+
+    # method to get the mean sentence loss so far (this synchronizes, so it is only called when the progress bar is updated)
+    def mean_loss(self):
+        return self.loss_sum.item() / max(self.num_samples, 1)
+
+    # method to get the mean training objective so far (the sentence loss plus the weighted token head loss, if any)
+    def mean_total_loss(self):
+        return self.total_loss_sum.item() / max(self.num_samples, 1)
+
+    # method to compute the exact dataset-level sentence loss and training objective, macro F1, macro precision, macro recall and confusion matrix
+    def compute(self):
+        matrix = self.matrix.cpu().double()
+        true_positives = matrix.diag()
+        # classes that are never predicted (or never present) count as 0, like sklearn's zero_division=0
+        precision = true_positives / matrix.sum(dim=0).clamp(min=1)
+        recall = true_positives / matrix.sum(dim=1).clamp(min=1)
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+        return {
+            'loss': self.mean_loss(),
+            'total_loss': self.mean_total_loss(),
+            'f1': f1.mean().item(),
+            'precision': precision.mean().item(),
+            'recall': recall.mean().item(),
+            'confusion_matrix': self.matrix.cpu().numpy(),
+        }
+
 
 class DebertaTrainer:
-    def __init__(self, dataset_train, dataset_val, dataset_test, num_classes=2, learning_rate=2e-5, eps=1e-8, weight_decay=0.01, betas=(0.9, 0.999), num_epochs=2, warmup_prop=0.1):
-        # Initialize DebertaClassifier model with specified number of classes
-        self.model = DebertaClassifier(num_classes)
+    def __init__(self, dataset_train, dataset_val, dataset_test, num_classes=2, learning_rate=2e-5, eps=1e-8, weight_decay=0.01, betas=(0.9, 0.999), num_epochs=2, warmup_prop=0.1,
+                 precision='fp32', gradient_accumulation_steps=1, gradient_checkpointing=False, log_every=50, prefetch_depth=0, token_head=False,
+                 trace_dir=None, trace_steps=(10, 15)):
+        # Initialize DebertaClassifier model with specified number of classes (and the optional token-level error head)
+        self.model = DebertaClassifier(num_classes, token_head=token_head)
         # Send the model to the GPU if available
-        self.model.cuda()
+        self.model.to(device)
         # Initialize hyperparameters
         self.learning_rate = learning_rate
         self.eps = eps
@@ -214,120 +428,182 @@ class DebertaTrainer:
         self.betas = betas
         self.num_epochs = num_epochs
         self.warmup_prop = warmup_prop
+        # 'bf16' runs the forward pass under bfloat16 autocast (supported on both CPU and GPU)
+        if precision not in ('fp32', 'bf16'):
+            raise ValueError(f"precision must be 'fp32' or 'bf16', got {precision!r}")
+        self.precision = precision
+        # number of batches whose gradients are summed before each optimizer step
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        # number of steps between progress bar updates (each update synchronizes with the device)
+        self.log_every = log_every
+        # number of batches loaded and copied to the device in the background while the current one runs (0 disables it)
+        self.prefetch_depth = prefetch_depth
+        # directory for a torch.profiler trace of the [start, end) training steps of the first epoch (None disables it)
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        # recompute the encoder activations in the backward pass instead of storing them
+        if gradient_checkpointing:
+            self.model.deberta.gradient_checkpointing_enable()
         
         # Create dataloaders for train, validation, and test datasets
         self.train_dataloader = dataset_train.train_dataloader
         self.validation_dataloader = dataset_val.val_dataloader
         self.test_dataloader = dataset_test.test_dataloader
 
-        # Initialize optimizer and scheduler
+        # Initialize optimizer and scheduler (which steps once per accumulated batch)
+        num_optimizer_steps = math.ceil(len(self.train_dataloader) / self.gradient_accumulation_steps) * self.num_epochs
         self.optimizer = AdamW(self.model.parameters(), lr=self.learning_rate, eps=self.eps, weight_decay=self.weight_decay, betas=self.betas)
-        self.scheduler = get_linear_schedule_with_warmup(self.optimizer, num_warmup_steps=len(self.train_dataloader) * self.num_epochs * self.warmup_prop, num_training_steps=len(self.train_dataloader) * self.num_epochs)
+        self.scheduler = get_linear_schedule_with_warmup(self.optimizer, num_warmup_steps=num_optimizer_steps * self.warmup_prop, num_training_steps=num_optimizer_steps)
+
+    # method to iterate over a dataloader, overlapping the loading of the next batches with the current step if enabled
+    def _batches(self, dataloader):
+        if self.prefetch_depth > 0:
+            return BackgroundPrefetcher(dataloader, device=device, depth=self.prefetch_depth)
+        return dataloader
+
+    # method to create a torch.profiler that records the configured window of training steps, if tracing is enabled
+    def _trace_profiler(self, epoch):
+        if self.trace_dir is None or epoch != 0:
+            return None
+        start, end = self.trace_steps
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=end - start, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
 
-    # This function is used to train the model for one epoch
-    def _train_epoch(self, epoch):
+    # method to get the autocast context for the configured precision
+    def _autocast(self):
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+    # This function is used to train the model for one epoch (or for its first max_steps batches)
+    def _train_epoch(self, epoch, max_steps=None):
         # Set the model to training mode
         self.model.train()
         
         # Initialize variables for tracking training progress
-        train_loss = 0
-        train_f1 = 0
-        train_precision = 0
-        num_train_steps = 0
-        
-        # Get an iterator for the training data
-        train_iterator = tqdm(self.train_dataloader, desc="Training")
+        metrics = MetricsAccumulator(num_classes, device=device)
+        num_batches = len(self.train_dataloader) if max_steps is None else min(max_steps, len(self.train_dataloader))
+        start_time = time.perf_counter()
+        # Track the peak memory of the epoch (the monitor is stopped even if training raises)
+        with PeakMemoryMonitor() as memory_monitor:
         
-        # Loop over each batch in the training data
-        for step, batch in enumerate(train_iterator):
-            # Extract the input_ids, attention_masks, and labels from the batch
-            input_ids = batch[0].to(device)
-            attention_masks = batch[1].to(device)
-            labels = batch[2].to(device)
+            # Get an iterator for the training data
+            train_iterator = tqdm(self._batches(self.train_dataloader), desc="Training", total=num_batches)
 
             # Clear the gradients
             self.model.zero_grad()
-            
-            # Forward pass through the model and calculate the loss and logits
-            loss, logits = self.model(input_ids, attention_mask=attention_masks, labels=labels)
-            
-            # Backpropagate the loss
-            loss.backward()
 
-            # Clip the gradients to avoid exploding gradients
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
-            
-            # Update the model parameters using the optimizer
-            self.optimizer.step()
+            # Start the torch.profiler trace, if enabled
+            trace = self._trace_profiler(epoch)
+            if trace is not None:
+                trace.start()
+        
+            # Loop over each batch in the training data
+            for step, batch in enumerate(train_iterator):
+                if step >= num_batches:
+                    break
+
+                # Extract the input_ids, attention_masks, and labels from the batch
+                with stage_profiler.stage('h2d_copy'):
+                    input_ids = batch[0].to(device, non_blocking=True)
+                    attention_masks = batch[1].to(device, non_blocking=True)
+                    labels = batch[2].to(device, non_blocking=True)
             
-            # Adjust the learning rate using the scheduler
-            self.scheduler.step()
-
-            # Update the training loss, F1 score, and precision for this batch
-            train_loss += loss.item()
-            train_f1 += f1_score(torch.argmax(logits, axis=1).cpu().numpy(), labels.cpu().numpy(), average='macro')
-            train_precision += precision_score(torch.argmax(logits, axis=1).cpu().numpy(), labels.cpu().numpy(), average='macro')
+                # Forward pass through the model and calculate the loss and logits
+                with self._autocast():
+                    loss, logits = self.model(input_ids, attention_mask=attention_masks, labels=labels)
             
-            # Increment the number of training steps
-            num_train_steps += 1
+                # Backpropagate the loss, scaled so that the accumulated gradient is an average over the batches of this step
+                # (the last group of an epoch can hold fewer than gradient_accumulation_steps batches)
+                group_start = step - step % self.gradient_accumulation_steps
+                group_size = min(self.gradient_accumulation_steps, num_batches - group_start)
+                (loss / group_size).backward()
+
+                # Step once every gradient_accumulation_steps batches, and on the last batch
+                if (step + 1) % self.gradient_accumulation_steps == 0 or step + 1 == num_batches:
+                    # Clip the gradients to avoid exploding gradients
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
+                
+                    # Update the model parameters using the optimizer
+                    self.optimizer.step()
+                
+                    # Adjust the learning rate using the scheduler
+                    self.scheduler.step()
+
+                    # Clear the gradients
+                    self.model.zero_grad()
+
+                # Update the training loss and confusion matrix for this batch, on the device
+                with stage_profiler.stage('metrics'):
+                    metrics.update(loss, logits, labels)
             
-            # Update the progress bar with the current epoch and training loss
-            train_iterator.set_description(f"Epoch {epoch+1} - Train loss: {train_loss/num_train_steps:.3f}")
+                # Update the progress bar with the current epoch and training loss every log_every steps
+                if (step + 1) % self.log_every == 0:
+                    train_iterator.set_description(f"Epoch {epoch+1} - Train loss: {metrics.mean_loss():.3f}")
+
+                # Advance the trace schedule
+                if trace is not None:
+                    trace.step()
+
+            # Stop the trace, which writes it to trace_dir
+            if trace is not None:
+                trace.stop()
+
+        # Calculate the training loss, F1 score, and precision over the whole epoch
+        with stage_profiler.stage('metrics'):
+            train_metrics = metrics.compute()
 
-        # Calculate the average training loss, F1 score, and precision over all training steps
-        train_loss /= num_train_steps
-        train_f1 /= num_train_steps
-        train_precision /= num_train_steps
+        # Print the training loss, F1 score, precision and recall for this epoch
+        print(f"Epoch {epoch+1} - Training loss: {train_metrics['loss']:.3f}, Training F1 score: {train_metrics['f1']:.3f}, "
+              f"Training Precision: {train_metrics['precision']:.3f}, Training Recall: {train_metrics['recall']:.3f}")
 
-        # Print the average training loss, F1 score, and precision for this epoch
-        print(f"Epoch {epoch+1} - Training loss: {train_loss:.3f}, Training F1 score: {train_f1:.3f}, Training Precision: {train_precision:.3f}")
+        # Print the training throughput and the peak memory used during this epoch
+        samples_per_sec = metrics.num_samples / (time.perf_counter() - start_time)
+        peak_memory = memory_monitor.peak
+        # the increase over the memory in use before the epoch (model and data already loaded) is what training itself needs
+        peak_memory_increase = peak_memory - memory_monitor.baseline
+        print(f"Epoch {epoch+1} - {samples_per_sec:.1f} samples/sec, peak memory: {peak_memory / 2**20:.0f} MiB "
+              f"(+{peak_memory_increase / 2**20:.0f} MiB during the epoch)")
+
+        return {'samples_per_sec': samples_per_sec, 'peak_memory_bytes': peak_memory, 'peak_memory_increase_bytes': peak_memory_increase}
 
     # Define a method for validation
     def evaluate(self):
         # Set the model in evaluation mode
         self.model.eval()
-        # Initialize variables for evaluation metrics
-        val_loss = 0
-        val_f1 = 0
-        val_precision = 0
-        num_val_steps = 0
-        # Initialize lists for collecting all predictions and labels for confusion matrix
-        all_predictions = []
-        all_labels = []
+        # Initialize the on-device accumulator of the evaluation metrics
+        metrics = MetricsAccumulator(num_classes, device=device)
 
         # Iterate over the validation data loader
-        for batch in tqdm(self.validation_dataloader, desc="Validation"):
+        for batch in tqdm(self._batches(self.validation_dataloader), desc="Validation"):
             # Extract input_ids, attention_masks, and labels from the batch and send them to device (CPU/GPU)
-            input_ids = batch[0].to(device)
-            attention_masks = batch[1].to(device)
-            labels = batch[2].to(device)
+            with stage_profiler.stage('h2d_copy'):
+                input_ids = batch[0].to(device, non_blocking=True)
+                attention_masks = batch[1].to(device, non_blocking=True)
+                labels = batch[2].to(device, non_blocking=True)
 
             # Disable gradient computation
             with torch.no_grad():
                 # Get the loss and logits from the model
-                loss, logits = self.model(input_ids, attention_mask=attention_masks, labels=labels)
-
-            # Update the loss and evaluation metrics
-            val_loss += loss.item()
-            # Compute F1 score for validation set by taking the argmax of the logits and comparing them to the labels
-            val_f1 += f1_score(torch.argmax(logits, axis=1).cpu().numpy(), labels.cpu().numpy(), average='macro')
-            # Compute Precision score for validation set by taking the argmax of the logits and comparing them to the labels
-            val_precision += precision_score(torch.argmax(logits, axis=1).cpu().numpy(), labels.cpu().numpy(), average='macro')
-            num_val_steps += 1
-
-            # Collect all predictions and labels for confusion matrix
-            all_predictions.extend(torch.argmax(logits, axis=1).cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-
-        # Compute the average validation loss and evaluation metrics
-        val_loss /= num_val_steps
-        val_f1 /= num_val_steps
-        val_precision /= num_val_steps
-        # Compute confusion matrix for the validation set using all the predictions and labels
-        cm = confusion_matrix(all_labels, all_predictions)
+                with self._autocast():
+                    loss, logits = self.model(input_ids, attention_mask=attention_masks, labels=labels)
+
+            # Update the loss and the confusion matrix
+            with stage_profiler.stage('metrics'):
+                metrics.update(loss, logits, labels)
+
+        # Compute the validation loss, F1 score, Precision score and confusion matrix over the whole validation set
+        with stage_profiler.stage('metrics'):
+            val_metrics = metrics.compute()
 
         # Return the validation loss, F1 score, Precision score, and confusion matrix
-        return (val_loss, val_f1, val_precision, cm)
+        return (val_metrics['loss'], val_metrics['f1'], val_metrics['precision'], val_metrics['confusion_matrix'])
 
     # Define a method for training
     def train(self):
@@ -357,15 +633,17 @@ class DebertaTrainer:
     # Define a method for training
     def test(self):
         # Load saved model from .pt file
-        self.model.load_state_dict(torch.load("model.pt"))
+        self.model.load_state_dict(torch.load("model.pt", map_location=device))
         self.model.eval()
 
         # Predict labels for test sentences
         predictions = []
-        for batch in tqdm(self.test_dataloader, desc="Testing"):
+        positions = []
+        for batch in tqdm(self._batches(self.test_dataloader), desc="Testing"):
             # Get input IDs and attention masks for current batch and move to device
-            input_ids = batch[0].to(device)
-            attention_masks = batch[1].to(device)
+            with stage_profiler.stage('h2d_copy'):
+                input_ids = batch[0].to(device, non_blocking=True)
+                attention_masks = batch[1].to(device, non_blocking=True)
 
             # Disable gradient computation
             with torch.no_grad():
@@ -379,23 +657,259 @@ class DebertaTrainer:
             batch_predictions = np.argmax(logits, axis=1)
             predictions.extend(batch_predictions)
 
-        # Combine predicted labels for all batches into a single list
-        predicted_labels = []
-        for batch in self.test_dataloader:
-            # Append predicted labels for current batch to output list
-            predicted_labels.extend(predictions[:len(batch[0])])
-            
-            # Remove predicted labels for current batch from predictions list
-            predictions = predictions[len(batch[0]):]
+            # Length-bucketed batches also carry the original positions of their sentences
+            if len(batch) == 3:
+                positions.extend(batch[2].tolist())
+
+        # Restore the original order of the test sentences
+        if positions:
+            ordered = [None] * len(predictions)
+            for position, prediction in zip(positions, predictions):
+                ordered[position] = prediction
+            predictions = ordered
 
         # Return predicted labels for all test sentences
-        return predicted_labels
+        return predictions
 
 """References"""
 
 # https://arxiv.org/abs/2111.09543
 # https://huggingface.co/yevheniimaslov/deberta-v3-base-cola/
 
+"""# Knowledge Distillation"""
+
+import torch.nn as nn
+import torch.nn.functional as F
+import pandas as pd
+from sklearn.metrics import f1_score
+
+# defining a small CNN over token embeddings, trained to mimic DebertaClassifier
+class StudentClassifier(nn.Module):
+    def __init__(self, vocab_size, num_classes=2, embedding_dim=128, num_filters=128, kernel_sizes=(2, 3, 4), dropout=0.1, pad_token_id=0):
+        super(StudentClassifier, self).__init__()
+        # keep the constructor arguments so that the model can be rebuilt from a checkpoint
+        self.config = {'vocab_size': vocab_size, 'num_classes': num_classes, 'embedding_dim': embedding_dim,
+                       'num_filters': num_filters, 'kernel_sizes': tuple(kernel_sizes), 'dropout': dropout, 'pad_token_id': pad_token_id}
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=pad_token_id)
+        # one convolution per n-gram width, each followed by mask-aware max pooling
+        self.convs = nn.ModuleList([nn.Conv1d(embedding_dim, num_filters, kernel_size, padding=kernel_size // 2) for kernel_size in kernel_sizes])
+        self.dropout = nn.Dropout(dropout)
+        self.fc = nn.Linear(num_filters * len(kernel_sizes), num_classes)
+
+    # method to compute the (unnormalized) class scores
+    def logits(self, input_ids, attention_mask):
+        mask = attention_mask.unsqueeze(1).to(torch.float32)
+        x = self.embedding(input_ids).transpose(1, 2) * mask
+        pooled = []
+        for conv in self.convs:
+            # even kernel sizes produce one extra position, which is dropped
+            h = F.relu(conv(x))[:, :, :input_ids.shape[1]] * mask
+            pooled.append(h.max(dim=2).values)
+        return self.fc(self.dropout(torch.cat(pooled, dim=1)))
+
+    # forward method with the same inputs and outputs as DebertaClassifier
+    def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None):
+        probabilities = F.softmax(self.logits(input_ids, attention_mask), dim=1)
+        outputs = (probabilities,)
+        if labels is not None:
+            outputs = (F.nll_loss(torch.log(probabilities.clamp(min=1e-12)), labels),) + outputs
+        return outputs
+
+
+# method to soften class probabilities with a temperature (the same as dividing the logits by it)
+def soften_probabilities(probabilities, temperature):
+    log_probabilities = torch.log(probabilities.clamp(min=1e-12)) / temperature
+    return F.softmax(log_probabilities, dim=-1)
+
+# method to train a student on the teacher's probabilities (and on the true labels where known)
+def distill(student, sentences, teacher_probabilities, labels=None, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', num_epochs=3, batch_size=64,
+            learning_rate=1e-3, temperature=2.0, alpha=0.5, max_length=128, cache_dir=None):
+    # sentences without a label (e.g. unlabeled text) are marked with -1 and only learn from the teacher
+    if labels is None:
+        labels = [-1] * len(sentences)
+    dataset = DebertaDataset(sentences, labels, tokenizer_name=tokenizer_name, batch_size=batch_size, max_length=max_length, cache_dir=cache_dir)
+    soft_targets = soften_probabilities(torch.as_tensor(np.asarray(teacher_probabilities), dtype=torch.float32), temperature)
+
+    student.to(device)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+    for epoch in range(num_epochs):
+        student.train()
+        total_loss = 0
+        num_steps = 0
+        for batch in tqdm(dataset.train_dataloader, desc=f"Distillation epoch {epoch + 1}"):
+            input_ids = batch[0].to(device, non_blocking=True)
+            attention_masks = batch[1].to(device, non_blocking=True)
+            batch_labels = batch[2].to(device, non_blocking=True)
+            targets = soft_targets[batch[3]].to(device, non_blocking=True)
+
+            logits = student.logits(input_ids, attention_masks)
+            # KL divergence to the softened teacher, scaled by T^2 to keep the gradient magnitude
+            loss = alpha * F.kl_div(F.log_softmax(logits / temperature, dim=1), targets, reduction='batchmean') * temperature ** 2
+            labeled = batch_labels >= 0
+            if labeled.any():
+                loss = loss + (1 - alpha) * F.cross_entropy(logits[labeled], batch_labels[labeled])
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.detach()
+            num_steps += 1
+
+        print(f"Distillation epoch {epoch + 1} - loss: {(total_loss / max(num_steps, 1)).item():.4f}")
+
+    student.eval()
+    return student
+
+# method to save a student together with its configuration
+def save_student(student, output_path):
+    torch.save({'config': student.config, 'state_dict': student.state_dict()}, output_path)
+
+
+# defining an inference class with the GrammarErrorDetector interface for a distilled student
+class StudentGrammarErrorDetector(GrammarErrorDetector):
+    def __init__(self, model_path='student.pt', tokenizer_name='sileod/deberta-v3-base-tasksource-nli', device=device, batch_size=256, max_length=128, cache=None,
+                 window_stride=None, window_aggregation='min'):
+        self._setup(model_path, tokenizer_name, device, batch_size, max_length, cache, window_stride, window_aggregation)
+
+        checkpoint = torch.load(model_path, map_location=self.device)
+        self.model = StudentClassifier(**checkpoint['config'])
+        self.model.load_state_dict(checkpoint['state_dict'])
+        self.model.to(self.device)
+        self.model.eval()
+
+
+# method to run the whole distillation: teacher soft targets, student training, and a report against the teacher
+def distillation_pipeline(teacher_path='model.pt', output_path='student.pt', train_path='dataset/train_data.csv', val_path='dataset/val_data.csv', unlabeled_sentences=None,
+                          tokenizer_name='sileod/deberta-v3-base-tasksource-nli', benchmark_sentences=1000, **distill_options):
+    teacher = GrammarErrorDetector(teacher_path, tokenizer_name=tokenizer_name)
+
+    # soft targets from the teacher on the training set and on any unlabeled text
+    train_df = pd.read_csv(train_path)
+    sentences = train_df['input'].astype(str).tolist()
+    labels = train_df['labels'].tolist()
+    if unlabeled_sentences:
+        sentences += [str(sent) for sent in unlabeled_sentences]
+        labels += [-1] * len(unlabeled_sentences)
+    teacher_probabilities = teacher.predict_proba(sentences)
+
+    tokenizer = get_tokenizer(tokenizer_name)
+    student = StudentClassifier(len(tokenizer), num_classes=num_classes, pad_token_id=tokenizer.pad_token_id or 0)
+    distill(student, sentences, teacher_probabilities, labels, tokenizer_name=tokenizer_name, **distill_options)
+    save_student(student, output_path)
+
+    # accuracy/F1 gap and throughput multiple on the validation set
+    val_df = pd.read_csv(val_path)
+    sentences_val = val_df['input'].astype(str).tolist()
+    labels_val = np.asarray(val_df['labels'].tolist())
+    student_detector = StudentGrammarErrorDetector(output_path, tokenizer_name=tokenizer_name)
+    report = {}
+    for name, detector in (('teacher', teacher), ('student', student_detector)):
+        predictions = detector.predict(sentences_val)
+        throughput = benchmark_detector(detector, sentences_val[:benchmark_sentences], batch_sizes=(32,))
+        report[name] = {
+            'accuracy': float((predictions == labels_val).mean()),
+            'f1': float(f1_score(labels_val, predictions, average='macro')),
+            'sentences_per_sec': throughput[32]['sentences_per_sec'],
+        }
+    report['accuracy_gap'] = report['teacher']['accuracy'] - report['student']['accuracy']
+    report['f1_gap'] = report['teacher']['f1'] - report['student']['f1']
+    report['throughput_multiple'] = report['student']['sentences_per_sec'] / report['teacher']['sentences_per_sec']
+
+    print(json.dumps(report, indent=2))
+    return report
+
+"""# Cascade Inference"""
+
+# method to find the lowest confidence threshold whose cascade accuracy still meets the target
+def calibrate_cascade_threshold(first_stage_probabilities, second_stage_probabilities, labels, target_accuracy):
+    labels = np.asarray(labels)
+    confidence = first_stage_probabilities.max(axis=1)
+    first_correct = first_stage_probabilities.argmax(axis=1) == labels
+    second_correct = second_stage_probabilities.argmax(axis=1) == labels
+
+    # sort by confidence: with a threshold at position i, sentences i.. stay in the first stage
+    order = np.argsort(confidence, kind='stable')
+    confidence, first_correct, second_correct = confidence[order], first_correct[order], second_correct[order]
+    # number of correct predictions if sentences [0, i) are escalated and [i, n) are not
+    escalated_correct = np.concatenate(([0], np.cumsum(second_correct)))
+    kept_correct = np.concatenate((np.cumsum(first_correct[::-1])[::-1], [0]))
+    accuracy = (escalated_correct + kept_correct) / len(labels)
+
+    # the cheapest cascade is the one that escalates the fewest sentences
+    for i in range(len(labels) + 1):
+        if accuracy[i] >= target_accuracy and (i == 0 or i == len(labels) or confidence[i - 1] < confidence[i]):
+            threshold = float(confidence[i]) if i < len(labels) else float('inf')
+            return threshold, float(accuracy[i]), i / len(labels)
+
+    # the target is out of reach, so every sentence goes to the second stage
+    return float('inf'), float(accuracy[-1]), 1.0
+
+
+# defining a two-stage detector that only sends the sentences the cheap first stage is unsure about to the full model
+# (a standalone class: it has no model or tokenizer of its own, only predict_proba and predict like the detectors it wraps)
+class CascadeGrammarErrorDetector:
+    def __init__(self, first_stage, second_stage, threshold=0.9):
+        # both stages are detectors with a predict_proba method, e.g. a StudentGrammarErrorDetector and a GrammarErrorDetector
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        # sentences whose first-stage confidence is below this go on to the second stage
+        self.threshold = threshold
+        self.stats = collections.Counter()
+        self.stage_time = collections.Counter()
+
+    # method to get the class probabilities of the given sentences, escalating only the uncertain ones
+    def predict_proba(self, sentences):
+        if len(sentences) == 0:
+            return np.zeros((0, num_classes), dtype=np.float32)
+        sentences = [str(sent) for sent in sentences]
+
+        start = time.perf_counter()
+        probabilities = self.first_stage.predict_proba(sentences)
+        self.stage_time['first_stage'] += time.perf_counter() - start
+
+        uncertain = np.flatnonzero(probabilities.max(axis=1) < self.threshold)
+        if len(uncertain):
+            start = time.perf_counter()
+            probabilities[uncertain] = self.second_stage.predict_proba([sentences[i] for i in uncertain])
+            self.stage_time['second_stage'] += time.perf_counter() - start
+
+        self.stats['sentences'] += len(sentences)
+        self.stats['escalated'] += len(uncertain)
+        return probabilities
+
+    # method to get the predicted labels (1 = grammatically correct, 0 = incorrect) of the given sentences
+    def predict(self, sentences):
+        return self.predict_proba(sentences).argmax(axis=1)
+
+    # method to tune the threshold on a labeled set so that the cascade reaches target_accuracy
+    def calibrate(self, sentences, labels, target_accuracy):
+        first_stage_probabilities = self.first_stage.predict_proba(sentences)
+        second_stage_probabilities = self.second_stage.predict_proba(sentences)
+        self.threshold, accuracy, escalated = calibrate_cascade_threshold(first_stage_probabilities, second_stage_probabilities, labels, target_accuracy)
+
+        second_stage_accuracy = float((second_stage_probabilities.argmax(axis=1) == np.asarray(labels)).mean())
+        result = {'threshold': self.threshold, 'cascade_accuracy': accuracy, 'second_stage_accuracy': second_stage_accuracy, 'escalated_fraction': escalated}
+        print(result)
+        return result
+
+    # method to get the per-stage routing counts, timings and the estimated compute saved
+    def routing_stats(self):
+        sentences = self.stats['sentences']
+        escalated = self.stats['escalated']
+        stats = {
+            'sentences': sentences,
+            'first_stage_only': sentences - escalated,
+            'escalated': escalated,
+            'escalated_fraction': escalated / sentences if sentences else 0.0,
+            'first_stage_s': self.stage_time['first_stage'],
+            'second_stage_s': self.stage_time['second_stage'],
+        }
+        # the time the second stage would have needed for every sentence, from its own per-sentence cost
+        if escalated:
+            full_cost = self.stage_time['second_stage'] / escalated * sentences
+            stats['compute_saved_fraction'] = 1 - (self.stage_time['first_stage'] + self.stage_time['second_stage']) / full_cost
+        return stats
+
 """# Runner Code"""
 
 # import necessary libraries
@@ -405,9 +919,11 @@ import numpy as np
 from sklearn.metrics import confusion_matrix
 
 # load training, validation, and testing data
-train_df = pd.read_csv('/content/sample_data/train_data.csv')
-val_df = pd.read_csv('/content/sample_data/val_data.csv')
-test_df = pd.read_excel("/content/sample_data/test_data.xlsx")
+# (set stage_profiler.enabled = True here to time every stage of the run)
+with stage_profiler.stage('io'):
+    train_df = pd.read_csv('/content/sample_data/train_data.csv')
+    val_df = pd.read_csv('/content/sample_data/val_data.csv')
+    test_df = pd.read_excel("/content/sample_data/test_data.xlsx")
 
 # convert input column in test data to string
 test_df['input'] = test_df['input'].astype(str)
@@ -431,9 +947,11 @@ sentences_test = test_df['input'].tolist()
 # torch.cuda.manual_seed_all(seed_val)
 
 # create DebertaDataset objects for the train, validation, and test datasets
-train_dataset = DebertaDataset(sentences_train, labels_train, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16)
-val_dataset = DebertaDataset(sentences_val, labels_val, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16)
-test_dataset = DebertaDataset(sentences_test, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16)
+# (tokenized sentences are cached under token_cache_dir so that reruns skip the tokenization)
+token_cache_dir = '/content/token_cache'
+train_dataset = DebertaDataset(sentences_train, labels_train, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, cache_dir=token_cache_dir)
+val_dataset = DebertaDataset(sentences_val, labels_val, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, cache_dir=token_cache_dir)
+test_dataset = DebertaDataset(sentences_test, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, cache_dir=token_cache_dir)
 
 # create a DebertaTrainer object with specified parameters
 deberta_model = DebertaTrainer(dataset_train=train_dataset, dataset_val=val_dataset, dataset_test=test_dataset,
@@ -443,7 +961,10 @@ deberta_model = DebertaTrainer(dataset_train=train_dataset, dataset_val=val_data
                              weight_decay=0.01,
                              betas=(0.9, 0.999),
                              num_epochs=2,
-                             warmup_prop=0.1)
+                             warmup_prop=0.1,
+                             precision='fp32',
+                             gradient_accumulation_steps=1,
+                             gradient_checkpointing=False)
 
 # train the Deberta model and save the best one
 deberta_model.train()
@@ -453,12 +974,420 @@ val_loss, val_f1, val_precision, confusion_matrix = deberta_model.evaluate()
 print(f"Validation loss: {val_loss:.3f}, Validation F1 score: {val_f1:.3f}, Validation Precision: {val_precision:.3f}")
 print(f"Confusion matrix:\n{confusion_matrix}")
 
-# Test the model
-test_preds = deberta_model.test()
+# Test the best saved model, scoring the sentences longer than max_length as overlapping windows instead of truncating them
+num_long_test_rows = int((test_dataset.lengths >= test_dataset.max_length).sum())
+print(f"{num_long_test_rows} of {len(sentences_test)} test sentences reach the {test_dataset.max_length}-token limit (longer ones are scored as windows)")
+test_detector = GrammarErrorDetector('model.pt', tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16,
+                                     max_length=test_dataset.max_length, window_stride=64)
+test_preds = test_detector.predict(sentences_test).tolist()
 
 """# Saving the predictions of test data"""
 
 print(len(test_preds))
 # Write the test_sentence and corresponding predicted-label pairs to a CSV file
 test_results = pd.DataFrame({"input": sentences_test, "labels": test_preds})
-test_results.to_csv('anannyo_dey_submission.csv')
\ No newline at end of file
+with stage_profiler.stage('io'):
+    test_results.to_csv('anannyo_dey_submission.csv')
+
+# Save the per-stage timings of the run, if profiling was enabled
+if stage_profiler.enabled:
+    stage_profiler.to_json('profile.json')
+    stage_profiler.to_prometheus('profile.prom')
+
+"""# Benchmarks"""
+
+import random
+import time
+import pandas as pd
+
+# set to True to run the benchmarks below after the predictions have been saved
+run_benchmarks = False
+
+# method to time inference over a test dataloader and collect probabilities in the original sentence order
+def _time_inference(model, dataloader, num_sentences):
+    probabilities = torch.zeros(num_sentences, num_classes)
+    real_tokens = 0
+    padded_tokens = 0
+    position = 0
+
+    start = time.perf_counter()
+    for batch in dataloader:
+        input_ids = batch[0].to(device)
+        attention_masks = batch[1].to(device)
+
+        with torch.no_grad():
+            probs, = model(input_ids, attention_mask=attention_masks)
+
+        # bucketed batches carry their sentence positions, fixed-length batches are sequential
+        if len(batch) == 3:
+            positions = batch[2]
+        else:
+            positions = torch.arange(position, position + len(input_ids))
+            position += len(input_ids)
+        probabilities[positions] = probs.float().cpu()
+
+        real_tokens += int(attention_masks.sum())
+        padded_tokens += input_ids.numel()
+    elapsed = time.perf_counter() - start
+
+    return probabilities, real_tokens, padded_tokens, elapsed
+
+# method to compare the fixed max_length padding with length-bucketed dynamic padding
+def benchmark_padding(sentences, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, max_length=128):
+    model = DebertaClassifier(num_classes).to(device)
+    model.eval()
+
+    results = {}
+    for name, dynamic_padding in (("fixed", False), ("bucketed", True)):
+        dataset = DebertaDataset(sentences, tokenizer_name=tokenizer_name, batch_size=batch_size, max_length=max_length, dynamic_padding=dynamic_padding)
+        probabilities, real_tokens, padded_tokens, elapsed = _time_inference(model, dataset.test_dataloader, len(sentences))
+        results[name] = probabilities
+        print(f"{name:>8}: {len(sentences) / elapsed:8.1f} sentences/sec, {real_tokens / elapsed:10.1f} real tokens/sec, "
+              f"{padded_tokens / elapsed:10.1f} padded tokens/sec, padding overhead {padded_tokens / real_tokens:.2f}x")
+
+    # both paths should give the same predictions
+    max_delta = (results["fixed"] - results["bucketed"]).abs().max().item()
+    agreement = (results["fixed"].argmax(dim=1) == results["bucketed"].argmax(dim=1)).float().mean().item()
+    print(f"Prediction agreement: {agreement:.4f}, max probability delta: {max_delta:.2e}")
+
+    return results
+
+# method to report samples/sec and peak memory of a few training steps for each trainer configuration
+def _training_benchmark_worker(dataset_train, dataset_val, dataset_test, config, max_steps, results):
+    try:
+        trainer = DebertaTrainer(dataset_train=dataset_train, dataset_val=dataset_val, dataset_test=dataset_test, num_epochs=1, **config)
+        results.put(trainer._train_epoch(0, max_steps=max_steps))
+    except Exception as e:
+        results.put({'failed': True, 'error': f'{type(e).__name__}: {e}'})
+
+# method to run _training_benchmark_worker in a fresh process, reporting the configuration as failed if the process dies or times out
+def _run_training_benchmark_process(dataset_train, dataset_val, dataset_test, config, max_steps, timeout=None):
+    context = multiprocessing.get_context('fork')
+    results_queue = context.Queue()
+    worker = context.Process(target=_training_benchmark_worker, args=(dataset_train, dataset_val, dataset_test, config, max_steps, results_queue))
+    worker.start()
+    deadline = time.perf_counter() + timeout if timeout is not None else None
+    try:
+        while True:
+            try:
+                return results_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+            # a process killed by the OOM killer (or crashing in native code) never puts its result
+            if not worker.is_alive():
+                try:
+                    return results_queue.get(timeout=1)
+                except queue.Empty:
+                    return {'failed': True, 'error': f'worker exited with code {worker.exitcode}'}
+            if deadline is not None and time.perf_counter() > deadline:
+                worker.terminate()
+                return {'failed': True, 'error': f'timed out after {timeout} s'}
+    finally:
+        worker.join()
+
+def benchmark_training(dataset_train, dataset_val, dataset_test, configs=None, max_steps=50, timeout=None):
+    if configs is None:
+        configs = [
+            {'precision': 'fp32'},
+            {'precision': 'bf16'},
+            {'precision': 'bf16', 'gradient_accumulation_steps': 8},
+            {'precision': 'bf16', 'gradient_accumulation_steps': 8, 'gradient_checkpointing': True},
+        ]
+
+    results = []
+    for config in configs:
+        if device.type == 'cuda':
+            # CUDA cannot be used again in a forked process, and the allocator's own peak is reset for every configuration
+            trainer = None
+            try:
+                trainer = DebertaTrainer(dataset_train=dataset_train, dataset_val=dataset_val, dataset_test=dataset_test, num_epochs=1, **config)
+                stats = trainer._train_epoch(0, max_steps=max_steps)
+            except torch.cuda.OutOfMemoryError as e:
+                stats = {'failed': True, 'error': f'{type(e).__name__}: {e}'}
+            del trainer
+            torch.cuda.empty_cache()
+        else:
+            # each configuration trains in a fresh process, as the memory freed by the previous ones is not returned to the OS
+            stats = _run_training_benchmark_process(dataset_train, dataset_val, dataset_test, config, max_steps, timeout=timeout)
+        results.append(dict(config, **stats))
+
+    for result in results:
+        print(result)
+    return results
+
+# method to compare the per-step cost of the old per-batch sklearn metrics with MetricsAccumulator
+def benchmark_metrics_overhead(num_steps=500, batch_size=16):
+    from sklearn.metrics import f1_score, precision_score
+    probabilities = torch.rand(num_steps, batch_size, num_classes, device=device).softmax(dim=2)
+    labels = torch.randint(0, num_classes, (num_steps, batch_size), device=device)
+    losses = torch.rand(num_steps, device=device)
+
+    # per-batch host syncs and sklearn calls, as the loops used to do
+    start = time.perf_counter()
+    for step in range(num_steps):
+        losses[step].item()
+        f1_score(torch.argmax(probabilities[step], axis=1).cpu().numpy(), labels[step].cpu().numpy(), average='macro')
+        precision_score(torch.argmax(probabilities[step], axis=1).cpu().numpy(), labels[step].cpu().numpy(), average='macro')
+    sklearn_time = (time.perf_counter() - start) / num_steps
+
+    # on-device accumulation, reduced once
+    start = time.perf_counter()
+    metrics = MetricsAccumulator(num_classes, device=device)
+    for step in range(num_steps):
+        metrics.update(losses[step], probabilities[step], labels[step])
+    metrics.compute()
+    accumulator_time = (time.perf_counter() - start) / num_steps
+
+    print(f"Metrics per step: sklearn {sklearn_time * 1000:.3f} ms, accumulator {accumulator_time * 1000:.3f} ms")
+    return {'sklearn_ms_per_step': sklearn_time * 1000, 'accumulator_ms_per_step': accumulator_time * 1000}
+
+# method to measure how much of each training step is spent waiting for the next batch, for several input pipeline settings
+def benchmark_input_pipeline(sentences, labels, configs=None, max_steps=50, batch_size=16):
+    if configs is None:
+        configs = [
+            {'num_workers': 0},
+            {'num_workers': 0, 'prefetch_depth': 2},
+            {'num_workers': 2, 'pin_memory': device.type == 'cuda'},
+            {'num_workers': 4, 'pin_memory': device.type == 'cuda', 'prefetch_depth': 2},
+        ]
+
+    model = DebertaClassifier(num_classes).to(device)
+    model.train()
+
+    results = []
+    for config in configs:
+        config = dict(config)
+        prefetch_depth = config.pop('prefetch_depth', 0)
+        dataset = DebertaDataset(sentences, labels, batch_size=batch_size, **config)
+        batches = BackgroundPrefetcher(dataset.train_dataloader, device=device, depth=prefetch_depth) if prefetch_depth > 0 else dataset.train_dataloader
+
+        wait_time = 0
+        num_steps = 0
+        start = time.perf_counter()
+        iterator = iter(batches)
+        while num_steps < max_steps:
+            # time spent blocked on the input pipeline
+            wait_start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            input_ids = batch[0].to(device, non_blocking=True)
+            attention_masks = batch[1].to(device, non_blocking=True)
+            labels_batch = batch[2].to(device, non_blocking=True)
+            wait_time += time.perf_counter() - wait_start
+
+            loss, _ = model(input_ids, attention_mask=attention_masks, labels=labels_batch)
+            loss.backward()
+            model.zero_grad()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            num_steps += 1
+        total_time = time.perf_counter() - start
+        del iterator
+
+        result = dict(config, prefetch_depth=prefetch_depth, step_ms=total_time / num_steps * 1000,
+                      data_wait_ms=wait_time / num_steps * 1000, data_wait_fraction=wait_time / total_time)
+        print(result)
+        results.append(result)
+
+    return results
+
+# method to time the runner's dataset construction, from a cold tokenizer registry
+def benchmark_startup(sentences_train, labels_train, sentences_val, labels_val, sentences_test, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', cache_dir=None):
+    get_tokenizer.cache_clear()
+    rss_before = PeakMemoryMonitor._current_rss()
+
+    start = time.perf_counter()
+    get_tokenizer(tokenizer_name)
+    tokenizer_time = time.perf_counter() - start
+
+    # build the three datasets and the one dataloader the runner uses from each
+    start = time.perf_counter()
+    train_dataset = DebertaDataset(sentences_train, labels_train, tokenizer_name=tokenizer_name, cache_dir=cache_dir)
+    val_dataset = DebertaDataset(sentences_val, labels_val, tokenizer_name=tokenizer_name, cache_dir=cache_dir)
+    test_dataset = DebertaDataset(sentences_test, tokenizer_name=tokenizer_name, cache_dir=cache_dir)
+    train_dataset.train_dataloader, val_dataset.val_dataloader, test_dataset.test_dataloader
+    datasets_time = time.perf_counter() - start
+
+    result = {
+        'tokenizer_load_s': tokenizer_time,
+        'datasets_s': datasets_time,
+        'tokenizer_loads': get_tokenizer.cache_info().misses,
+        'rss_delta_mib': (PeakMemoryMonitor._current_rss() - rss_before) / 2**20,
+    }
+    print(result)
+    return result
+
+# method to read this process' resident and proportional set sizes (Linux), where PSS splits shared pages between processes
+def _memory_usage():
+    usage = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                usage[fields[0][:-1].lower()] = int(fields[1]) * 1024
+    return usage
+
+def _cold_start_worker(load, sentences, results):
+    start = time.perf_counter()
+    detector = load()
+    load_time = time.perf_counter() - start
+    detector.predict(sentences)
+    results.put(dict(_memory_usage(), load_s=load_time))
+
+# method to compare the cold start and per-worker memory of loading model.pt with loading the memory-mapped artifact
+def benchmark_cold_start(model_path='model.pt', artifact_dir='artifact', num_workers=4, sentences=("This is a sentence.",)):
+    context = multiprocessing.get_context('fork')
+    loaders = {
+        'model.pt': partial(GrammarErrorDetector, model_path, device='cpu'),
+        'artifact': partial(GrammarErrorDetector.from_artifact, artifact_dir),
+    }
+
+    results = {}
+    for name, load in loaders.items():
+        # all workers load at the same time, as a fleet of freshly started serving processes would
+        results_queue = context.Queue()
+        workers = [context.Process(target=_cold_start_worker, args=(load, list(sentences), results_queue)) for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        stats = [results_queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        results[name] = {key: float(np.mean([stat[key] for stat in stats])) for key in stats[0]}
+        print(f"{name:>9}: load {results[name]['load_s']:.2f} s, RSS {results[name]['rss'] / 2**20:.0f} MiB, "
+              f"PSS {results[name]['pss'] / 2**20:.0f} MiB, private {(results[name]['private_clean'] + results[name]['private_dirty']) / 2**20:.0f} MiB per worker")
+    return results
+
+# method to measure how scoring throughput scales with the number of single-threaded workers, and chart the curve
+def benchmark_scaling(input_path, artifact_dir='artifact', worker_counts=None, chunk_size=500):
+    if worker_counts is None:
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= os.cpu_count():
+            worker_counts.append(worker_counts[-1] * 2)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_workers in worker_counts:
+            start = time.perf_counter()
+            num_sentences = score_file_sharded(input_path, os.path.join(tmp_dir, 'scores.csv'), artifact_dir=artifact_dir,
+                                               num_workers=num_workers, threads_per_worker=1, chunk_size=chunk_size)
+            results[num_workers] = num_sentences / (time.perf_counter() - start)
+
+    # text chart of the throughput, and of the speedup against the ideal linear scaling
+    scale = 50 / max(results.values())
+    for num_workers, throughput in results.items():
+        speedup = throughput / results[worker_counts[0]]
+        print(f"{num_workers:>4} workers | {'#' * int(throughput * scale):<50} {throughput:8.1f} sentences/sec, "
+              f"speedup {speedup:.2f}x ({speedup / (num_workers / worker_counts[0]):.0%} of linear)")
+    return results
+
+# method to compare the per-sentence latency of sentence-only scoring with scoring plus error localization
+def benchmark_token_head(detector, sentences, num_repeats=3):
+    timings = {}
+    for name, score in (('sentence only', detector.predict_proba), ('with error spans', detector.locate_errors)):
+        score(sentences[:detector.batch_size])
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            score(sentences)
+        timings[name] = (time.perf_counter() - start) / (num_repeats * len(sentences))
+
+    overhead = timings['with error spans'] / timings['sentence only'] - 1
+    print(f"Per sentence: {timings['sentence only'] * 1000:.3f} ms sentence only, "
+          f"{timings['with error spans'] * 1000:.3f} ms with error spans ({overhead:+.1%})")
+    return timings
+
+# method to run a reproducible benchmark suite on the bundled dataset files and write its results (with a stage profile) to JSON
+def run_benchmark_suite(dataset_dir='dataset', output_path='benchmark_results.json', num_sentences=2000, batch_size=16, train_steps=20, seed=42):
+    import transformers
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    stage_profiler.reset()
+    stage_profiler.enabled = True
+    results = {'environment': {'torch': torch.__version__, 'transformers': transformers.__version__, 'device': str(device),
+                               'threads': torch.get_num_threads()}}
+    try:
+        # reading the bundled files
+        start = time.perf_counter()
+        with stage_profiler.stage('io'):
+            train_df = pd.read_csv(os.path.join(dataset_dir, 'train_data.csv'))
+            val_df = pd.read_csv(os.path.join(dataset_dir, 'val_data.csv'))
+            test_df = pd.read_excel(os.path.join(dataset_dir, 'test_data.xlsx'))
+        results['io_s'] = time.perf_counter() - start
+
+        sentences_train = train_df['input'].astype(str).tolist()[:num_sentences]
+        labels_train = train_df['labels'].tolist()[:num_sentences]
+        sentences_val = val_df['input'].astype(str).tolist()[:num_sentences]
+        labels_val = val_df['labels'].tolist()[:num_sentences]
+        sentences_test = test_df['input'].astype(str).tolist()[:num_sentences]
+
+        # tokenization without the token cache
+        get_tokenizer('sileod/deberta-v3-base-tasksource-nli')
+        start = time.perf_counter()
+        train_dataset = DebertaDataset(sentences_train, labels_train, batch_size=batch_size)
+        val_dataset = DebertaDataset(sentences_val, labels_val, batch_size=batch_size)
+        test_dataset = DebertaDataset(sentences_test, batch_size=batch_size)
+        results['tokenize_sentences_per_sec'] = 3 * num_sentences / (time.perf_counter() - start)
+
+        # a few training steps, validation and test inference
+        trainer = DebertaTrainer(dataset_train=train_dataset, dataset_val=val_dataset, dataset_test=test_dataset, num_epochs=1)
+        results['train'] = trainer._train_epoch(0, max_steps=train_steps)
+        start = time.perf_counter()
+        val_loss, val_f1, val_precision, _ = trainer.evaluate()
+        results['validation_sentences_per_sec'] = len(sentences_val) / (time.perf_counter() - start)
+
+        probabilities, real_tokens, _, elapsed = _time_inference(trainer.model, test_dataset.test_dataloader, len(sentences_test))
+        results['test_sentences_per_sec'] = len(sentences_test) / elapsed
+        results['test_tokens_per_sec'] = real_tokens / elapsed
+        results['metrics'] = benchmark_metrics_overhead()
+
+        results['stages'] = stage_profiler.stages
+        results['counters'] = dict(stage_profiler.counters)
+    finally:
+        stage_profiler.enabled = False
+
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2, default=float)
+    print(json.dumps(results, indent=2, default=float))
+    return results
+
+# method to compare truncation with sliding windows on the long-tail rows of the test set
+def benchmark_long_inputs(detector, sentences, window_stride=64, max_length=128, batch_size=32):
+    tokenizer = detector.tokenizer
+    window_size = max_length - tokenizer.num_special_tokens_to_add()
+    token_counts = np.array([len(ids) for ids in tokenizer(list(sentences), add_special_tokens=False)['input_ids']])
+    long_sentences = [sent for sent, count in zip(sentences, token_counts) if count > window_size]
+    long_counts = token_counts[token_counts > window_size]
+    if not long_sentences:
+        print(f"No sentences longer than {window_size} tokens")
+        return {}
+
+    results = {'long_sentences': len(long_sentences), 'max_tokens': int(long_counts.max())}
+    predictions = {}
+    for name, stride in (('truncated', None), ('windowed', window_stride)):
+        start = time.perf_counter()
+        probabilities = predict_proba_batched(detector.model, tokenizer, long_sentences, batch_size=batch_size, max_length=max_length,
+                                              device=detector.device, window_stride=stride)
+        results[f'{name}_s'] = time.perf_counter() - start
+        predictions[name] = probabilities.argmax(axis=1)
+
+    # tokens scored by the windows, against padding every long sentence to the longest one
+    _, window_lengths, _ = tokenize_windows(long_sentences, tokenizer, max_length, window_stride)
+    results['windows'] = len(window_lengths)
+    results['windowed_tokens'] = int(window_lengths.sum())
+    results['actual_tokens'] = int(long_counts.sum())
+    results['worst_case_padded_tokens'] = int(len(long_sentences) * long_counts.max())
+    results['changed_verdicts'] = int((predictions['truncated'] != predictions['windowed']).sum())
+    print(results)
+    return results
+
+if run_benchmarks:
+    run_benchmark_suite()
+    benchmark_long_inputs(GrammarErrorDetector('model.pt'), sentences_test)
+    benchmark_startup(sentences_train, labels_train, sentences_val, labels_val, sentences_test, cache_dir=token_cache_dir)
+    benchmark_padding(sentences_test[:2000])
+    benchmark_input_pipeline(sentences_train[:4000], labels_train[:4000])
+    benchmark_metrics_overhead()
+    benchmark_training(train_dataset, val_dataset, test_dataset)
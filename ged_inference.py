@@ -0,0 +1,1442 @@
+# -*- coding: utf-8 -*-
+"""Inference, serving and batch scoring for the DeBERTaV3 + CNN grammatical error detector.
+
+Everything a serving process needs lives here, and nothing that trains: importing this module only defines classes and
+functions. GED_Main.py imports it for the model, tokenization and profiling code it shares with training.
+
+Usage:
+    python ged_inference.py score test_data.xlsx submission.csv --artifact-dir artifact --workers 4
+    python ged_inference.py serve --artifact-dir artifact --port 8000
+"""
+
+import collections
+import contextlib
+import copy
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+# use the GPU if there's one available
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+"""# Profiling"""
+
+# defining opt-in per-stage timers, counters and peak memory for training and inference
+class StageProfiler:
+    def __init__(self, enabled=False, synchronize=True, memory_interval=0.01):
+        # wait for queued GPU work at stage boundaries so that asynchronous kernels are charged to the right stage
+        self.synchronize = synchronize
+        # interval at which the process RSS is sampled on the CPU (the CUDA allocator tracks its own peak)
+        self.memory_interval = memory_interval
+        self._rss_monitor = None
+        # memory windows that are currently open, innermost last
+        self._open_windows = []
+        self.enabled = enabled
+        self.reset()
+
+    # profiling can be switched on and off at any time (switching it off also stops the background RSS sampling)
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        self._enabled = enabled
+        if not enabled and not self._open_windows:
+            self._stop_rss_monitor()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = collections.Counter()
+        if not self._open_windows:
+            self._stop_rss_monitor()
+
+    # method to time a block of code as the given stage (a no-op while disabled)
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            with self.memory_window() as window:
+                yield
+                self._synchronize()
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'memory_high_water_bytes': 0})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['memory_high_water_bytes'] = max(stats['memory_high_water_bytes'], window.peak)
+
+    # method to track the peak memory of a block of code (GPU allocations on CUDA, sampled process RSS otherwise),
+    # including the transient allocations freed before it ends; the yielded window holds the peak once the block has exited
+    @contextlib.contextmanager
+    def memory_window(self):
+        window = MemoryWindow()
+        self._open_memory_window(window)
+        try:
+            yield window
+        finally:
+            self._close_memory_window(window)
+
+    # method to read the peak memory since the last reset
+    def _memory_peak(self):
+        if device.type == 'cuda':
+            return torch.cuda.max_memory_allocated()
+        if self._rss_monitor is None:
+            return PeakMemoryMonitor._current_rss()
+        return max(self._rss_monitor.peak, PeakMemoryMonitor._current_rss())
+
+    def _reset_memory_peak(self):
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        elif self._rss_monitor is not None:
+            self._rss_monitor.peak = PeakMemoryMonitor._current_rss()
+
+    def _open_memory_window(self, window):
+        if device.type != 'cuda' and self._rss_monitor is None:
+            self._rss_monitor = PeakMemoryMonitor(interval=self.memory_interval).start()
+        # the enclosing windows keep the peak they reached so far, as the reset below would lose it
+        peak = self._memory_peak()
+        for open_window in self._open_windows:
+            open_window.peak = max(open_window.peak, peak)
+        self._reset_memory_peak()
+        self._open_windows.append(window)
+
+    def _close_memory_window(self, window):
+        window.peak = max(window.peak, self._memory_peak())
+        # windows are removed by identity, so that one closed out of order cannot corrupt the others
+        self._open_windows.remove(window)
+        # the peak of a nested window is also reached within the enclosing ones
+        for open_window in self._open_windows:
+            open_window.peak = max(open_window.peak, window.peak)
+        if not self._open_windows and not self.enabled:
+            self._stop_rss_monitor()
+
+    def _stop_rss_monitor(self):
+        if self._rss_monitor is not None:
+            self._rss_monitor.stop()
+            self._rss_monitor = None
+
+    def _synchronize(self):
+        if self.synchronize and device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    # method to increment a named counter (a no-op while disabled)
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    # method to export the stages and counters as JSON
+    def to_json(self, path=None):
+        report = json.dumps({'stages': self.stages, 'counters': dict(self.counters)}, indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(report)
+        return report
+
+    # method to export the stages and counters in the Prometheus text format
+    def to_prometheus(self, path=None, prefix='ged'):
+        metrics = [
+            ('stage_seconds_total', 'counter', 'seconds'),
+            ('stage_calls_total', 'counter', 'calls'),
+            ('stage_max_seconds', 'gauge', 'max_seconds'),
+            ('stage_memory_high_water_bytes', 'gauge', 'memory_high_water_bytes'),
+        ]
+        lines = []
+        for metric, metric_type, key in metrics:
+            lines.append(f"# TYPE {prefix}_{metric} {metric_type}")
+            lines.extend(f'{prefix}_{metric}{{stage="{name}"}} {stats[key]}' for name, stats in sorted(self.stages.items()))
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        lines.extend(f'{prefix}_events_total{{name="{name}"}} {value}' for name, value in sorted(self.counters.items()))
+        report = "\n".join(lines) + "\n"
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(report)
+        return report
+
+
+# defining the peak memory (in bytes) reached while a StageProfiler.memory_window was open
+class MemoryWindow:
+    def __init__(self):
+        self.peak = 0
+
+
+# process-wide profiler used by the dataset, model, trainer and inference code (enable with stage_profiler.enabled = True)
+stage_profiler = StageProfiler()
+
+
+# defining a monitor of the peak memory used between start() and stop(), or within a with block
+class PeakMemoryMonitor:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        # memory in use when monitoring started, so that the increase over it can be reported
+        self.baseline = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._window_context = None
+        self._window = None
+        self._running = False
+
+    # method to read the resident set size of this process (Linux), or 0 when unavailable
+    @staticmethod
+    def _current_rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return 0
+
+    def _poll(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, self._current_rss())
+
+    def start(self):
+        if device.type == 'cuda':
+            # the CUDA allocator tracks its own high-water mark, which the profiled stages also reset: the window is
+            # opened through stage_profiler so that the peaks of the stages nested in it are kept
+            self.baseline = torch.cuda.memory_allocated()
+            self._window_context = stage_profiler.memory_window()
+            self._window = self._window_context.__enter__()
+        else:
+            # sample the process RSS in the background
+            self.baseline = self.peak = self._current_rss()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+        self._running = True
+        return self
+
+    # method to stop monitoring and return the peak memory in bytes (also kept in self.peak)
+    def stop(self):
+        if not self._running:
+            return self.peak
+        self._running = False
+        if device.type == 'cuda':
+            self._window_context.__exit__(None, None, None)
+            self.peak = self._window.peak
+            self._window_context = self._window = None
+        else:
+            self._stop_event.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._current_rss())
+        return self.peak
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+"""# Tokenization and Batching"""
+
+# defining a batch sampler that groups sentences of similar token length together
+class LengthBucketSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size_multiplier=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # number of batches whose sentences are sorted together when shuffling
+        self.bucket_size = batch_size * bucket_size_multiplier
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        lengths = np.asarray(self.lengths)
+        if self.shuffle:
+            # shuffle the sentences, then sort them by length only within large buckets
+            # so that batches stay random across epochs but tightly packed
+            indices = torch.randperm(len(lengths)).numpy()
+            indices = np.concatenate([bucket[np.argsort(lengths[bucket], kind='stable')]
+                                      for bucket in np.array_split(indices, range(self.bucket_size, len(indices), self.bucket_size))])
+        else:
+            # sort all sentences by length for deterministic validation and testing
+            indices = np.argsort(lengths, kind='stable')
+
+        batches = [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+
+        # shuffle the order of the batches themselves while training
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        return iter(batches)
+
+
+# defining a container of variable-length token ids stored as one flat array plus offsets
+class RaggedTokenIds:
+    def __init__(self, token_ids, offsets):
+        # both arrays may be memory-mapped from the token cache
+        self.token_ids = token_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return torch.from_numpy(np.asarray(self.token_ids[start:end], dtype=np.int64))
+
+    # method to get the token length of every sentence
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # method to pad all sentences to max_length, as the fixed-length dataloaders expect
+    def to_padded(self, max_length, pad_token_id=0):
+        input_ids = torch.full((len(self), max_length), pad_token_id, dtype=torch.long)
+        attention_masks = torch.zeros((len(self), max_length), dtype=torch.long)
+        for i in range(len(self)):
+            sequence = self[i]
+            input_ids[i, :len(sequence)] = sequence
+            attention_masks[i, :len(sequence)] = 1
+        return input_ids, attention_masks
+
+
+# method to get a tokenizer, loading each tokenizer only once per process and sharing it afterwards
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_name):
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+# process-local tokenizer used by the tokenization workers
+_worker_tokenizer = None
+
+def init_tokenizer_worker(tokenizer_name):
+    global _worker_tokenizer
+    _worker_tokenizer = get_tokenizer(tokenizer_name)
+
+# method to tokenize one chunk of sentences with the (Rust) fast tokenizer batch API
+def tokenize_chunk(sentences, max_length, tokenizer=None):
+    tokenizer = tokenizer or _worker_tokenizer
+    encoded = tokenizer(
+        list(sentences),           # Sentences to encode.
+        add_special_tokens=True,   # Add '[CLS]' and '[SEP]'
+        max_length=max_length,     # Truncate all sentences, padding is done per batch.
+        truncation=True,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )['input_ids']
+    lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+    token_ids = np.fromiter((token for ids in encoded for token in ids), dtype=np.int32, count=int(lengths.sum()))
+    return token_ids, lengths
+
+
+# method to pad every batch only up to the length of its longest sentence
+def pad_collate(batch, pad_token_id=0):
+    # the last element of every sample is its original position in the dataset
+    sequences = [sample[0] for sample in batch]
+    indices = torch.tensor([sample[-1] for sample in batch], dtype=torch.long)
+
+    # pad the token ids and build the matching attention masks
+    input_ids = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True, padding_value=pad_token_id)
+    attention_masks = torch.zeros_like(input_ids)
+    for i, sequence in enumerate(sequences):
+        attention_masks[i, :len(sequence)] = 1
+
+    if len(batch[0]) == 3:
+        labels = torch.stack([torch.as_tensor(sample[1]) for sample in batch])
+        return input_ids, attention_masks, labels, indices
+    return input_ids, attention_masks, indices
+
+"""# DeBERTaV3 + CNN Classifier Model"""
+
+num_classes = 2
+
+# Define a class DebertaClassifier that inherits from nn.Module
+class DebertaClassifier(nn.Module):
+    # Constructor method for the DebertaClassifier class
+    def __init__(self, num_classes, backbone_config=None, token_head=False, token_loss_weight=1.0):
+        # Call the constructor of the superclass (nn.Module)
+        super(DebertaClassifier, self).__init__()
+        # Load the pre-trained DeBERTa model (or only build its architecture when the weights come from elsewhere)
+        if backbone_config is None:
+            self.deberta = AutoModel.from_pretrained('yevheniimaslov/deberta-v3-base-cola')
+        else:
+            self.deberta = AutoModel.from_config(backbone_config)
+        # Define a dropout layer with 10% dropout probability
+        self.dropout = nn.Dropout(0.1)
+        # Define a 1D convolutional layer with 768 input channels, 256 output channels, and kernel size 3
+        self.conv1d = nn.Conv1d(in_channels=768, out_channels=256, kernel_size=3, padding=1)        
+        # Define a ReLU activation function
+        self.relu = nn.ReLU()
+        # Define an adaptive max pooling layer with output size 1
+        self.pooling = nn.AdaptiveMaxPool1d(1)
+        # Define a fully connected (linear) layer with 256 input features and num_classes output features
+        self.fc1 = nn.Linear(256, num_classes)
+        # Define a softmax activation function
+        self.softmax = nn.Softmax(dim=1)
+        # Optionally define a token-level head scoring every position of the convolutional feature map as erroneous
+        self.token_head = nn.Conv1d(in_channels=256, out_channels=1, kernel_size=1) if token_head else None
+        # Weight of the token head loss, which is trained from the sentence labels only (a sentence is incorrect if any token is)
+        self.token_loss_weight = token_loss_weight
+        
+    # method to get the positions of the sentence tokens: [CLS] (the first position) and [SEP] (the last real position)
+    # have no character span, so the token head must not be able to explain a sentence label with them
+    @staticmethod
+    def _content_token_mask(input_ids, attention_mask):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        mask = attention_mask.bool().clone()
+        mask[:, 0] = False
+        last_positions = attention_mask.sum(dim=1).long() - 1
+        mask[torch.arange(mask.shape[0], device=mask.device), last_positions.clamp(min=0)] = False
+        return mask
+
+    # Define the forward method for the DebertaClassifier class
+    def forward(self, input_ids, attention_mask, token_type_ids=None, labels=None, return_token_scores=False):
+        # Pass the input through the DeBERTa model and obtain the last hidden state
+        with stage_profiler.stage('encoder'):
+            outputs = self.deberta(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        last_hidden_state = outputs.last_hidden_state
+        # Pass the last hidden state through the convolutional head
+        with stage_profiler.stage('head'):
+            # Transpose the last hidden state so that the channels dimension comes second
+            last_hidden_state = last_hidden_state.transpose(1,2)
+            # Apply dropout to the last hidden state
+            x = self.dropout(last_hidden_state)
+            # Zero the padded positions so that the convolution sees the same input however much padding there is
+            if attention_mask is not None:
+                mask = attention_mask.unsqueeze(1).to(x.dtype)
+                x = x * mask
+            # Apply the 1D convolutional layer to the last hidden state
+            x = self.conv1d(x)
+            # Apply the ReLU activation function to the output of the convolutional layer
+            x = self.relu(x)
+            # Exclude the padded positions from the pooling (the ReLU outputs are non-negative, so zeroed pads never change the max)
+            if attention_mask is not None:
+                x = x * mask
+            # Score every token from the same feature map, with padded positions and the special tokens pushed to -inf
+            token_logits = None
+            if self.token_head is not None and (return_token_scores or labels is not None):
+                token_logits = self.token_head(x).squeeze(1)
+                token_logits = token_logits.masked_fill(~self._content_token_mask(input_ids, attention_mask), float('-inf'))
+            # Apply the adaptive max pooling layer to the output of the ReLU activation function
+            x = self.pooling(x).squeeze(-1)
+            # Apply the fully connected layer to the output of the adaptive max pooling layer
+            x = self.fc1(x)
+            # Apply the softmax activation function to the output of the fully connected layer
+            x = self.softmax(x)
+            # Create a tuple of outputs containing the predicted class probabilities (and the per-token error scores if requested)
+            outputs = (x,)
+            if return_token_scores and token_logits is not None:
+                outputs = outputs + (torch.sigmoid(token_logits),)
+            # If labels are provided, calculate the cross-entropy loss and add it to the outputs tuple
+            if labels is not None:
+                loss_fct = nn.CrossEntropyLoss()
+                loss = loss_fct(x.view(-1, num_classes), labels.view(-1))
+                # The highest token score of a sentence should match whether it is incorrect (label 0)
+                if token_logits is not None:
+                    sentence_error_logits = token_logits.max(dim=1).values
+                    # sentences without any content token (only [CLS] and [SEP]) contribute a constant instead of an infinite loss
+                    sentence_error_logits = sentence_error_logits.masked_fill(torch.isneginf(sentence_error_logits), 0.0)
+                    loss = loss + self.token_loss_weight * nn.functional.binary_cross_entropy_with_logits(sentence_error_logits, (labels.view(-1) == 0).to(sentence_error_logits.dtype))
+                outputs = (loss,) + outputs
+        
+        return outputs
+
+"""# Prediction Cache"""
+
+import sqlite3
+import unicodedata
+
+# method to normalize a sentence for cache lookups (unicode form and whitespace only, case is kept)
+def normalize_sentence(sentence):
+    return ' '.join(unicodedata.normalize('NFC', str(sentence)).split())
+
+# method to hash a checkpoint file, so that cached predictions are tied to the weights that produced them
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# defining a bounded LRU cache of class probabilities with an optional SQLite tier
+class PredictionCache:
+    def __init__(self, max_entries=100000, max_bytes=None, sqlite_path=None):
+        self.max_entries = max_entries
+        # approximate memory budget for keys and probabilities (None means only max_entries applies)
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.counters = collections.Counter(hits=0, misses=0, evictions=0, disk_hits=0)
+        self.lock = threading.Lock()
+
+        # the SQLite tier keeps every prediction across restarts, beyond the in-memory budget
+        self.db = None
+        if sqlite_path is not None:
+            self.db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, probabilities BLOB)")
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # method to build the cache key of a sentence for a given model
+    @staticmethod
+    def make_key(sentence, model_hash):
+        return f"{model_hash}:{normalize_sentence(sentence)}"
+
+    @staticmethod
+    def _entry_size(key, probabilities):
+        return len(key) + probabilities.nbytes
+
+    def _insert(self, key, probabilities):
+        if key in self.entries:
+            self.num_bytes -= self._entry_size(key, self.entries.pop(key))
+        self.entries[key] = probabilities
+        self.num_bytes += self._entry_size(key, probabilities)
+
+        # evict the least recently used entries until both budgets are met
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.num_bytes > self.max_bytes and len(self.entries) > 1):
+            old_key, old_probabilities = self.entries.popitem(last=False)
+            self.num_bytes -= self._entry_size(old_key, old_probabilities)
+            self.counters['evictions'] += 1
+
+    # method to look up many keys at once, returning None for every miss
+    def get_many(self, keys):
+        results = []
+        with self.lock:
+            for key in keys:
+                probabilities = self.entries.get(key)
+                if probabilities is not None:
+                    self.entries.move_to_end(key)
+                elif self.db is not None:
+                    row = self.db.execute("SELECT probabilities FROM predictions WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        probabilities = np.frombuffer(row[0], dtype=np.float32).copy()
+                        self._insert(key, probabilities)
+                        self.counters['disk_hits'] += 1
+                self.counters['hits' if probabilities is not None else 'misses'] += 1
+                results.append(probabilities)
+        return results
+
+    # method to store the probabilities of many keys at once
+    def put_many(self, keys, probabilities):
+        with self.lock:
+            for key, sentence_probabilities in zip(keys, probabilities):
+                self._insert(key, np.asarray(sentence_probabilities, dtype=np.float32))
+            if self.db is not None:
+                self.db.executemany("INSERT OR REPLACE INTO predictions (key, probabilities) VALUES (?, ?)",
+                                    [(key, np.asarray(p, dtype=np.float32).tobytes()) for key, p in zip(keys, probabilities)])
+                self.db.commit()
+
+    # method to get the hit, miss and eviction counters
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.num_bytes)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+"""# Inference"""
+
+# method to run the model over variable-length token sequences, batching sequences of similar length together
+def _score_token_sequences(model, input_ids, lengths, pad_token_id, batch_size=32, device=device):
+    probabilities = np.zeros((len(input_ids), num_classes), dtype=np.float32)
+    for batch_indices in LengthBucketSampler(lengths, batch_size):
+        batch_input_ids, batch_attention_masks, positions = pad_collate([(input_ids[i], i) for i in batch_indices], pad_token_id=pad_token_id)
+        with stage_profiler.stage('h2d_copy'):
+            batch_input_ids = batch_input_ids.to(device)
+            batch_attention_masks = batch_attention_masks.to(device)
+        with torch.inference_mode():
+            batch_probabilities, = model(batch_input_ids, attention_mask=batch_attention_masks)
+        probabilities[positions.numpy()] = batch_probabilities.float().cpu().numpy()
+
+    return probabilities
+
+# method to get the number of sentence tokens that fit in a window next to the special tokens, checking the stride against it
+def _window_size(tokenizer, max_length, stride):
+    window_size = max_length - tokenizer.num_special_tokens_to_add()
+    # a stride beyond the window size would skip the tokens between two windows
+    if not 0 < stride <= window_size:
+        raise ValueError(f"window_stride must be in (0, {window_size}] for max_length={max_length}, got {stride!r}")
+    return window_size
+
+def _check_window_options(tokenizer, max_length, stride, aggregation):
+    _window_size(tokenizer, max_length, stride)
+    if aggregation not in ('min', 'mean'):
+        raise ValueError(f"window_aggregation must be 'min' or 'mean', got {aggregation!r}")
+
+# method to split every sentence into windows of at most max_length tokens (special tokens included) starting every stride tokens
+def tokenize_windows(sentences, tokenizer, max_length, stride):
+    window_size = _window_size(tokenizer, max_length, stride)
+    # the fast tokenizer emits the overflowing windows itself; its stride is the number of tokens shared by consecutive windows
+    encoded = tokenizer(list(sentences), max_length=max_length, truncation=True, stride=window_size - stride,
+                        return_overflowing_tokens=True, return_attention_mask=False)
+
+    lengths = np.array([len(window) for window in encoded['input_ids']], dtype=np.int64)
+    token_ids = np.fromiter((token for window in encoded['input_ids'] for token in window), dtype=np.int32, count=int(lengths.sum()))
+    return token_ids, lengths, np.array(encoded['overflow_to_sample_mapping'], dtype=np.int64)
+
+# method to predict class probabilities for a list of sentences, batching sentences of similar length together;
+# with window_stride set, long sentences are scored as overlapping windows instead of being truncated at max_length
+def predict_proba_batched(model, tokenizer, sentences, batch_size=32, max_length=128, device=device, window_stride=None, window_aggregation='min'):
+    pad_token_id = tokenizer.pad_token_id or 0
+    stage_profiler.count('sentences_scored', len(sentences))
+
+    if window_stride is None:
+        with stage_profiler.stage('tokenize'):
+            token_ids, lengths = tokenize_chunk(sentences, max_length, tokenizer=tokenizer)
+        input_ids = RaggedTokenIds(token_ids, np.concatenate(([0], np.cumsum(lengths))))
+        return _score_token_sequences(model, input_ids, lengths, pad_token_id, batch_size=batch_size, device=device)
+
+    # the windows of all sentences are bucketed and batched together
+    _check_window_options(tokenizer, max_length, window_stride, window_aggregation)
+    with stage_profiler.stage('tokenize'):
+        token_ids, lengths, owners = tokenize_windows(sentences, tokenizer, max_length, window_stride)
+    stage_profiler.count('windows_scored', len(owners))
+    input_ids = RaggedTokenIds(token_ids, np.concatenate(([0], np.cumsum(lengths))))
+    window_probabilities = _score_token_sequences(model, input_ids, lengths, pad_token_id, batch_size=batch_size, device=device)
+
+    # aggregate the windows back into one verdict per sentence
+    probabilities = np.zeros((len(sentences), num_classes), dtype=np.float32)
+    if window_aggregation == 'mean':
+        np.add.at(probabilities, owners, window_probabilities)
+        probabilities /= np.bincount(owners, minlength=len(sentences))[:, None]
+    else:
+        # a sentence is as correct as its least correct window (class 1 is grammatically correct)
+        probabilities[:] = np.inf
+        for owner, window in zip(owners, window_probabilities):
+            if window[1] < probabilities[owner, 1]:
+                probabilities[owner] = window
+    return probabilities
+
+
+# method to build a DebertaClassifier from a saved state dict, reading its weights only once
+# (the backbone is built from its configuration alone, so the pre-trained weights are never downloaded or loaded)
+def load_classifier(model_path, device=device, quantized=False, token_head=False, backbone_name='yevheniimaslov/deberta-v3-base-cola'):
+    backbone_config = AutoConfig.from_pretrained(backbone_name)
+    if quantized:
+        # quantize_dynamic needs concrete float modules to replace, so the architecture is allocated on the CPU first
+        model = quantize_dynamic_int8(DebertaClassifier(num_classes, backbone_config=backbone_config, token_head=token_head))
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        return model.eval()
+
+    # build the architecture without allocating (or initializing) any weights, then adopt the loaded tensors as they are
+    with torch.device('meta'):
+        model = DebertaClassifier(num_classes, backbone_config=backbone_config, token_head=token_head)
+    model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True), assign=True)
+
+    # non-persistent buffers are not part of the state dict, so they are rebuilt on the target device
+    for name, buffer in list(model.named_buffers()):
+        if not buffer.is_meta:
+            continue
+        if not name.endswith('position_ids'):
+            raise ValueError(f"Cannot rebuild buffer {name} missing from {model_path}")
+        module_name, _, buffer_name = name.rpartition('.')
+        position_ids = torch.arange(buffer.shape[-1], device=device).expand(buffer.shape)
+        model.get_submodule(module_name).register_buffer(buffer_name, position_ids, persistent=False)
+    return model.eval()
+
+# defining an inference-only wrapper around a trained DebertaClassifier
+class GrammarErrorDetector:
+    def __init__(self, model_path='model.pt', tokenizer_name='sileod/deberta-v3-base-tasksource-nli', device=device, batch_size=32, max_length=128, quantized=False, cache=None, token_head=False,
+                 window_stride=None, window_aggregation='min'):
+        self._setup(model_path, tokenizer_name, device, batch_size, max_length, cache, window_stride, window_aggregation)
+
+        # load the trained weights once, straight onto the target device
+        # (quantized=True expects a state dict written by export_quantized, which only runs on the CPU)
+        self.model = load_classifier(model_path, device=self.device, quantized=quantized, token_head=token_head)
+
+    # method to create a detector from an inference artifact written by export_inference_artifact (CPU only, as the weights stay memory-mapped)
+    @classmethod
+    def from_artifact(cls, artifact_dir, batch_size=32, cache=None, compile=False, window_stride=None, window_aggregation='min'):
+        detector = cls.__new__(cls)
+        detector.model, metadata = load_inference_artifact(artifact_dir, compile=compile)
+        detector._setup(os.path.join(artifact_dir, 'weights.pt'), metadata['tokenizer_name'], 'cpu', batch_size, metadata['max_length'], cache,
+                        window_stride, window_aggregation)
+        return detector
+
+    # method to set up everything but the model, shared by the ways of creating a detector
+    def _setup(self, weights_path, tokenizer_name, device, batch_size, max_length, cache, window_stride=None, window_aggregation='min'):
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = get_tokenizer(tokenizer_name)
+        # score long sentences as windows of max_length tokens starting every window_stride tokens (None truncates them)
+        if window_stride is not None:
+            _check_window_options(self.tokenizer, max_length, window_stride, window_aggregation)
+        self.window_stride = window_stride
+        self.window_aggregation = window_aggregation
+        # optional PredictionCache in front of the model, keyed by the weights hash (and the window settings)
+        self.cache = cache
+        self.model_hash = file_sha256(weights_path) if cache is not None else None
+        if self.model_hash is not None and window_stride is not None:
+            self.model_hash += f":window-{window_stride}-{window_aggregation}"
+
+    # method to run the model on the given sentences
+    def _predict_proba_uncached(self, sentences):
+        return predict_proba_batched(self.model, self.tokenizer, sentences,
+                                     batch_size=self.batch_size, max_length=self.max_length, device=self.device,
+                                     window_stride=self.window_stride, window_aggregation=self.window_aggregation)
+
+    # method to get the class probabilities of the given sentences
+    def predict_proba(self, sentences):
+        if len(sentences) == 0:
+            return np.zeros((0, num_classes), dtype=np.float32)
+        sentences = [str(sent) for sent in sentences]
+        if self.cache is None:
+            return self._predict_proba_uncached(sentences)
+
+        keys = [self.cache.make_key(sent, self.model_hash) for sent in sentences]
+        cached = self.cache.get_many(keys)
+
+        # only the distinct cache misses are sent to the model
+        missing = {}
+        for sent, key, probabilities in zip(sentences, keys, cached):
+            if probabilities is None and key not in missing:
+                missing[key] = sent
+        if missing:
+            missing_probabilities = self._predict_proba_uncached(list(missing.values()))
+            self.cache.put_many(list(missing.keys()), missing_probabilities)
+            computed = dict(zip(missing.keys(), missing_probabilities))
+            cached = [probabilities if probabilities is not None else computed[key] for key, probabilities in zip(keys, cached)]
+
+        return np.stack(cached).astype(np.float32)
+
+    # method to get the predicted labels (1 = grammatically correct, 0 = incorrect) of the given sentences
+    def predict(self, sentences):
+        return self.predict_proba(sentences).argmax(axis=1)
+
+    # method to get, in the same forward pass, the sentence label and the character spans of the tokens scored as errors
+    def locate_errors(self, sentences, threshold=0.5):
+        if getattr(self.model, 'token_head', None) is None:
+            raise ValueError("locate_errors needs a model trained with token_head=True")
+        sentences = [str(sent) for sent in sentences]
+        encoded = self.tokenizer(sentences, add_special_tokens=True, max_length=self.max_length, truncation=True,
+                                 return_attention_mask=False, return_offsets_mapping=True)
+        lengths = [len(ids) for ids in encoded['input_ids']]
+        pad_token_id = self.tokenizer.pad_token_id or 0
+
+        results = [None] * len(sentences)
+        for batch_indices in LengthBucketSampler(lengths, self.batch_size):
+            batch_input_ids, batch_attention_masks, positions = pad_collate(
+                [(torch.tensor(encoded['input_ids'][i], dtype=torch.long), i) for i in batch_indices], pad_token_id=pad_token_id)
+            with torch.inference_mode():
+                probabilities, token_scores = self.model(batch_input_ids.to(self.device), attention_mask=batch_attention_masks.to(self.device), return_token_scores=True)
+            probabilities = probabilities.float().cpu().numpy()
+            token_scores = token_scores.float().cpu().numpy()
+
+            for row, i in enumerate(positions.tolist()):
+                results[i] = {
+                    'label': int(probabilities[row].argmax()),
+                    'probabilities': probabilities[row].tolist(),
+                    'spans': _error_spans(encoded['offset_mapping'][i], token_scores[row, :lengths[i]], threshold),
+                }
+        return results
+
+
+# method to merge the flagged tokens of a sentence into (start, end, score) character spans
+def _error_spans(offsets, token_scores, threshold):
+    spans = []
+    for (start, end), score in zip(offsets, token_scores):
+        # special tokens have an empty offset
+        if end <= start or score < threshold:
+            continue
+        # extend the previous span when this token directly follows it (allowing for one separating space)
+        if spans and start - spans[-1][1] <= 1:
+            spans[-1] = (spans[-1][0], end, max(spans[-1][2], float(score)))
+        else:
+            spans.append((start, end, float(score)))
+    return spans
+
+"""# Inference Artifact"""
+
+# method to write a single inference artifact (backbone and head weights plus their configuration) to artifact_dir
+def export_inference_artifact(model, artifact_dir, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', max_length=128):
+    os.makedirs(artifact_dir, exist_ok=True)
+
+    # non-persistent buffers are not part of the state dict, but are needed to run the model without re-initializing it
+    tensors = dict(model.state_dict())
+    for name, buffer in model.named_buffers():
+        tensors.setdefault(name, buffer)
+    # contiguous, unshared CPU copies keep the file compact and every tensor page-aligned for mmap (the model itself stays where it is)
+    torch.save({name: tensor.detach().to('cpu', memory_format=torch.contiguous_format, copy=True) for name, tensor in tensors.items()},
+               os.path.join(artifact_dir, 'weights.pt'))
+
+    model.deberta.config.save_pretrained(artifact_dir)
+    with open(os.path.join(artifact_dir, 'artifact.json'), 'w') as f:
+        json.dump({'num_classes': model.fc1.out_features, 'tokenizer_name': tokenizer_name, 'max_length': max_length,
+                   'token_head': model.token_head is not None}, f)
+    return artifact_dir
+
+# method to load an inference artifact without copying its weights: the tensors stay memory-mapped from the file,
+# so every process that loads the same artifact shares the same physical pages
+def load_inference_artifact(artifact_dir, compile=False):
+    with open(os.path.join(artifact_dir, 'artifact.json')) as f:
+        metadata = json.load(f)
+    backbone_config = AutoConfig.from_pretrained(artifact_dir)
+
+    # build the architecture without allocating (or initializing) any weights
+    with torch.device('meta'):
+        model = DebertaClassifier(metadata['num_classes'], backbone_config=backbone_config, token_head=metadata.get('token_head', False))
+    tensors = torch.load(os.path.join(artifact_dir, 'weights.pt'), mmap=True, weights_only=True, map_location='cpu')
+
+    # assign the memory-mapped tensors to the model instead of copying them into new storage
+    state_dict_keys = set(model.state_dict().keys())
+    model.load_state_dict({name: tensor for name, tensor in tensors.items() if name in state_dict_keys}, assign=True)
+    for name, tensor in tensors.items():
+        if name not in state_dict_keys:
+            module_name, _, buffer_name = name.rpartition('.')
+            model.get_submodule(module_name).register_buffer(buffer_name, tensor, persistent=False)
+    model.eval()
+
+    if compile:
+        model = torch.compile(model, dynamic=True)
+    return model, metadata
+
+"""# Streaming Inference"""
+
+import pandas as pd
+
+# method to read the sentences of a CSV, XLSX or line-delimited text file in chunks, skipping the first `start` sentences
+def iter_sentence_chunks(path, chunk_size=10000, column='input', start=0):
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.csv':
+        # row 0 is the header, rows 1..start have already been scored
+        reader = pd.read_csv(path, usecols=[column], chunksize=chunk_size, skiprows=lambda row: 0 < row <= start)
+        for chunk in reader:
+            yield chunk[column].astype(str).tolist()
+        return
+
+    if extension in ('.xlsx', '.xlsm'):
+        # openpyxl's read-only mode streams the rows instead of loading the whole sheet
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows)
+            column_index = list(header).index(column)
+            chunk = []
+            for row_number, row in enumerate(rows):
+                if row_number < start:
+                    continue
+                value = row[column_index]
+                chunk.append('' if value is None else str(value))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            workbook.close()
+        return
+
+    # any other file is read as one sentence per line
+    with open(path, encoding='utf-8') as f:
+        chunk = []
+        for line_number, line in enumerate(f):
+            if line_number < start:
+                continue
+            chunk.append(line.rstrip('\n'))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+# defining a predictor that scores arbitrarily large files chunk by chunk
+class StreamingPredictor:
+    def __init__(self, model, tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=16, max_length=128, chunk_size=10000, device=device, window_stride=None, window_aggregation='min'):
+        # the model is expected to be loaded and to return a tuple with the class probabilities
+        self.model = model
+        self.tokenizer = get_tokenizer(tokenizer_name)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.device = device
+        # score long sentences as overlapping windows instead of truncating them (see predict_proba_batched)
+        self.window_stride = window_stride
+        self.window_aggregation = window_aggregation
+
+    # method to predict the labels of one chunk of sentences, in their original order
+    def predict_chunk(self, sentences):
+        self.model.eval()
+        probabilities = predict_proba_batched(self.model, self.tokenizer, sentences, batch_size=self.batch_size,
+                                              max_length=self.max_length, device=self.device,
+                                              window_stride=self.window_stride, window_aggregation=self.window_aggregation)
+        return probabilities.argmax(axis=1)
+
+    # method to yield (sentences, predictions) for every chunk of the input, starting after `start` sentences
+    def predict_stream(self, input_path, column='input', start=0):
+        for sentences in iter_sentence_chunks(input_path, chunk_size=self.chunk_size, column=column, start=start):
+            yield sentences, self.predict_chunk(sentences)
+
+    # method to score a whole file into a submission-style CSV, resuming from checkpoint_path if given
+    def predict_file(self, input_path, output_path, column='input', checkpoint_path=None):
+        # the checkpoint records how many sentences (and output bytes) have been safely written
+        offset, output_size = 0, 0
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            offset, output_size = checkpoint['offset'], checkpoint['output_size']
+
+        with open(output_path, 'a+', newline='', encoding='utf-8') as f:
+            # drop anything written after the last checkpoint (e.g. a chunk interrupted by a crash)
+            f.truncate(output_size)
+            f.seek(output_size)
+            writer = csv.writer(f)
+            if output_size == 0:
+                writer.writerow(['', 'input', 'labels'])
+
+            for sentences, predictions in tqdm(self.predict_stream(input_path, column=column, start=offset), desc="Streaming"):
+                with stage_profiler.stage('io'):
+                    writer.writerows(zip(range(offset, offset + len(sentences)), sentences, predictions.tolist()))
+                offset += len(sentences)
+
+                if checkpoint_path is not None:
+                    # make sure the rows are on disk before recording them in the checkpoint
+                    f.flush()
+                    os.fsync(f.fileno())
+                    tmp_checkpoint_path = checkpoint_path + '.tmp'
+                    with open(tmp_checkpoint_path, 'w') as checkpoint_file:
+                        json.dump({'offset': offset, 'output_size': f.tell()}, checkpoint_file)
+                    os.replace(tmp_checkpoint_path, checkpoint_path)
+
+        return offset
+
+"""# CPU Serving Export (int8 and ONNX)"""
+
+# method to copy a model to the CPU in evaluation mode, leaving the given model (its device and training mode) as it was
+def _cpu_eval_copy(model):
+    # the parameters and buffers are copied straight to the CPU, so a GPU model is never duplicated on the GPU
+    memo = {}
+    for tensor in itertools.chain(model.parameters(), model.buffers()):
+        copied = tensor.detach().to('cpu', copy=True)
+        memo[id(tensor)] = nn.Parameter(copied, requires_grad=tensor.requires_grad) if isinstance(tensor, nn.Parameter) else copied
+    return copy.deepcopy(model, memo).eval()
+
+# method to quantize the Linear layers of the backbone and of the head to int8 (dynamic quantization)
+def quantize_dynamic_int8(model):
+    # dynamic quantization only covers nn.Linear, so the conv1d layer of the head stays in fp32
+    return torch.ao.quantization.quantize_dynamic(_cpu_eval_copy(model), {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+# method to save an int8 version of a trained model, loadable with GrammarErrorDetector(quantized=True)
+def export_quantized(model, output_path):
+    quantized_model = quantize_dynamic_int8(model)
+    torch.save(quantized_model.state_dict(), output_path)
+    return quantized_model
+
+# method to export a trained model to ONNX with dynamic batch and sequence axes
+def export_onnx(model, output_path, tokenizer, max_length=128, opset_version=18):
+    model = _cpu_eval_copy(model)
+    dummy = tokenizer(["This is a sentence.", "This is another sentence."], padding=True, truncation=True,
+                      max_length=max_length, return_tensors='pt')
+    torch.onnx.export(
+        model,
+        (dummy['input_ids'], dummy['attention_mask']),
+        output_path,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['probabilities'],
+        dynamic_axes={
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'probabilities': {0: 'batch'},
+        },
+        opset_version=opset_version,
+    )
+    return output_path
+
+
+# defining an adapter that makes an onnxruntime session callable like DebertaClassifier
+class _OnnxModel:
+    def __init__(self, session):
+        self.session = session
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask):
+        probabilities, = self.session.run(['probabilities'], {
+            'input_ids': input_ids.cpu().numpy(),
+            'attention_mask': attention_mask.cpu().numpy(),
+        })
+        return (torch.from_numpy(probabilities),)
+
+
+# defining an inference class with the GrammarErrorDetector interface that runs an exported ONNX graph
+class OnnxGrammarErrorDetector(GrammarErrorDetector):
+    def __init__(self, onnx_path='model.onnx', tokenizer_name='sileod/deberta-v3-base-tasksource-nli', batch_size=32, max_length=128, num_threads=None, cache=None,
+                 window_stride=None, window_aggregation='min'):
+        self._setup(onnx_path, tokenizer_name, 'cpu', batch_size, max_length, cache, window_stride, window_aggregation)
+
+        # onnxruntime is only needed when serving the ONNX graph
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        session = onnxruntime.InferenceSession(onnx_path, session_options, providers=['CPUExecutionProvider'])
+        self.model = _OnnxModel(session)
+
+
+# method to compare a candidate model with the fp32 reference on a labeled dataset
+def check_parity(reference, candidate, sentences, labels):
+    reference_probabilities = reference.predict_proba(sentences)
+    candidate_probabilities = candidate.predict_proba(sentences)
+    labels = np.asarray(labels)
+
+    reference_accuracy = (reference_probabilities.argmax(axis=1) == labels).mean()
+    candidate_accuracy = (candidate_probabilities.argmax(axis=1) == labels).mean()
+    return {
+        'reference_accuracy': float(reference_accuracy),
+        'candidate_accuracy': float(candidate_accuracy),
+        'accuracy_delta': float(candidate_accuracy - reference_accuracy),
+        'agreement': float((reference_probabilities.argmax(axis=1) == candidate_probabilities.argmax(axis=1)).mean()),
+        'max_probability_delta': float(np.abs(reference_probabilities - candidate_probabilities).max()),
+    }
+
+# method to measure per-batch latency and throughput of a detector
+def benchmark_detector(detector, sentences, batch_sizes=(1, 8, 32), num_batches=20):
+    results = {}
+    for batch_size in batch_sizes:
+        # warm up once before timing
+        detector.predict_proba(sentences[:batch_size])
+        latencies = []
+        for i in range(num_batches):
+            batch = sentences[i * batch_size:(i + 1) * batch_size] or sentences[:batch_size]
+            start = time.perf_counter()
+            detector.predict_proba(batch)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies)
+        results[batch_size] = {
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'sentences_per_sec': float(batch_size * num_batches / latencies.sum()),
+        }
+    return results
+
+# method to export int8 and ONNX versions of a trained model, check them against fp32 and benchmark all three
+def export_for_cpu_serving(model_path='model.pt', output_dir='export', val_path='dataset/val_data.csv', tokenizer_name='sileod/deberta-v3-base-tasksource-nli', benchmark_sentences=1000):
+    os.makedirs(output_dir, exist_ok=True)
+    reference = GrammarErrorDetector(model_path, tokenizer_name=tokenizer_name, device='cpu')
+
+    # write both artifacts
+    quantized_path = os.path.join(output_dir, 'model_int8.pt')
+    onnx_path = os.path.join(output_dir, 'model.onnx')
+    export_quantized(reference.model, quantized_path)
+    export_onnx(reference.model, onnx_path, reference.tokenizer, max_length=reference.max_length)
+
+    candidates = {
+        'int8': GrammarErrorDetector(quantized_path, tokenizer_name=tokenizer_name, device='cpu', quantized=True),
+        'onnx': OnnxGrammarErrorDetector(onnx_path, tokenizer_name=tokenizer_name),
+    }
+
+    # check the quality of every artifact against the fp32 model on the validation set
+    val_df = pd.read_csv(val_path)
+    sentences_val = val_df['input'].astype(str).tolist()
+    labels_val = val_df['labels'].tolist()
+    report = {'parity': {}, 'benchmark': {'fp32': benchmark_detector(reference, sentences_val[:benchmark_sentences])}}
+    for name, candidate in candidates.items():
+        report['parity'][name] = check_parity(reference, candidate, sentences_val, labels_val)
+        report['benchmark'][name] = benchmark_detector(candidate, sentences_val[:benchmark_sentences])
+
+    print(json.dumps(report, indent=2))
+    return report
+
+"""# Micro-batching Scoring Server"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# defining a queue that coalesces concurrent scoring requests into padded batches
+class MicroBatcher:
+    def __init__(self, detector, max_batch_size=32, max_wait_ms=5, max_queue_size=1024):
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # sentences waiting beyond this limit are rejected instead of queued (backpressure)
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        # the model runs in a single background thread so the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    # method to check whether the given number of sentences can be queued right now
+    def has_capacity(self, num_sentences):
+        return self.queue.maxsize - self.queue.qsize() >= num_sentences
+
+    # method to score sentences, returning their class probabilities once their batch has run
+    async def submit(self, sentences):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sent in sentences:
+            future = loop.create_future()
+            self.queue.put_nowait((str(sent), future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for the first sentence, then keep collecting until the batch is full or the wait is over
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            sentences = [sent for sent, _ in batch]
+            self.batch_sizes.append(len(batch))
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self.detector.predict_proba, sentences)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # fan the results back out to the waiting requests
+            for (_, future), sentence_probabilities in zip(batch, probabilities):
+                if not future.done():
+                    future.set_result(sentence_probabilities.tolist())
+
+
+# defining a minimal asyncio HTTP server around a MicroBatcher
+class ScoringServer:
+    def __init__(self, detector, host='127.0.0.1', port=8000, max_batch_size=32, max_wait_ms=5, max_queue_size=1024, max_sentences_per_request=256,
+                 max_body_bytes=2**20):
+        # a request larger than the queue could never be accepted, and would be rejected as overloaded forever
+        if max_sentences_per_request > max_queue_size:
+            raise ValueError(f"max_sentences_per_request ({max_sentences_per_request}) must not exceed max_queue_size ({max_queue_size})")
+        self.detector = detector
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.max_sentences_per_request = max_sentences_per_request
+        # request bodies are read into memory, so larger ones are refused before reading them
+        self.max_body_bytes = max_body_bytes
+        self.batcher = None
+        self.server = None
+        self.ready = False
+        # request latencies in seconds and request counters for /metrics
+        self.latencies = collections.deque(maxlen=10000)
+        self.counters = collections.Counter()
+
+    async def start(self):
+        self.batcher = MicroBatcher(self.detector, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms, max_queue_size=self.max_queue_size)
+        self.batcher.start()
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # the actual port, in case port 0 was requested
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready = True
+
+    async def stop(self):
+        self.ready = False
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.batcher is not None:
+            await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    # method to compute the request latency percentiles and batching statistics
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batcher.batch_sizes) if self.batcher is not None else np.array([])
+        return {
+            'requests': dict(self.counters),
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else None,
+            'queue_size': self.batcher.queue.qsize() if self.batcher is not None else 0,
+        }
+
+    async def _handle_connection(self, reader, writer):
+        # the connection is always closed, whatever happens while handling the request
+        try:
+            try:
+                status, body = await self._handle_request(reader)
+            except (asyncio.IncompleteReadError, ValueError) as e:
+                status, body = 400, {'error': str(e)}
+            except Exception as e:
+                self.counters['failed'] += 1
+                status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+            payload = json.dumps(body).encode('utf-8')
+            writer.write((f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\n"
+                          f"Content-Type: application/json\r\n"
+                          f"Content-Length: {len(payload)}\r\n"
+                          f"Connection: close\r\n\r\n").encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            # the client went away before the response was sent
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader):
+        # parse the request line and the headers
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            raise ValueError('malformed request line')
+        method, path = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/ready':
+            return (200, {'status': 'ready'}) if self.ready else (503, {'status': 'not ready'})
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics()
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': 'not found'}
+
+        content_length = int(headers.get('content-length', 0))
+        if content_length < 0:
+            raise ValueError('invalid Content-Length')
+        if content_length > self.max_body_bytes:
+            return 413, {'error': f'the request body must be at most {self.max_body_bytes} bytes'}
+
+        # accept either {"sentence": "..."} or {"sentences": [...]}
+        body = json.loads(await reader.readexactly(content_length) or b'{}')
+        if not isinstance(body, dict):
+            return 400, {'error': 'the request body must be a JSON object'}
+        sentences = body['sentences'] if 'sentences' in body else [body.get('sentence', '')]
+        if not isinstance(sentences, list) or not all(isinstance(sent, str) for sent in sentences):
+            return 400, {'error': '"sentences" must be a list of strings and "sentence" a string'}
+        if len(sentences) > self.max_sentences_per_request:
+            return 413, {'error': f'at most {self.max_sentences_per_request} sentences per request'}
+
+        # reject the request straight away when the queue is full
+        if not self.ready or not self.batcher.has_capacity(len(sentences)):
+            self.counters['rejected'] += 1
+            return 503, {'error': 'overloaded'}
+
+        start = time.perf_counter()
+        try:
+            probabilities = await self.batcher.submit(sentences)
+        except Exception as e:
+            # the model failed on the batch holding these sentences
+            self.counters['failed'] += 1
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+        self.latencies.append(time.perf_counter() - start)
+        self.counters['served'] += 1
+        return 200, {
+            'labels': [int(np.argmax(p)) for p in probabilities],
+            'probabilities': probabilities,
+        }
+
+
+_HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# method to send one JSON request to the scoring server and return the status and decoded response
+async def _http_request(host, port, method, path, body=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    writer.write((f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+                  f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n").encode('latin-1') + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body)
+
+# method to fire single-sentence requests at the server from `concurrency` concurrent clients
+async def run_load_test(host, port, sentences, concurrency=32):
+    queue = collections.deque(sentences)
+    latencies = []
+    statuses = collections.Counter()
+
+    async def client():
+        while queue:
+            sent = queue.popleft()
+            start = time.perf_counter()
+            status, _ = await _http_request(host, port, 'POST', '/predict', {'sentence': sent})
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests_per_sec': len(sentences) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'statuses': dict(statuses),
+    }
+
+# method to compare micro-batched serving with naive per-request scoring (max_batch_size=1)
+def benchmark_server(detector, sentences, concurrency=32, max_batch_size=32, max_wait_ms=5):
+    async def run(batch_size):
+        server = ScoringServer(detector, port=0, max_batch_size=batch_size, max_wait_ms=max_wait_ms, max_queue_size=max(1024, concurrency))
+        await server.start()
+        try:
+            return await run_load_test(server.host, server.port, sentences, concurrency=concurrency)
+        finally:
+            await server.stop()
+
+    results = {}
+    for name, batch_size in (('per-request', 1), ('micro-batched', max_batch_size)):
+        results[name] = asyncio.run(run(batch_size))
+        print(f"{name:>13}: {results[name]['requests_per_sec']:8.1f} requests/sec, "
+              f"p50 {results[name]['p50_ms']:.1f} ms, p99 {results[name]['p99_ms']:.1f} ms")
+    return results
+
+"""# Multi-process Batch Scoring"""
+
+import argparse
+
+# detector of the current scoring worker process
+_scoring_detector = None
+
+def _init_scoring_worker(artifact_dir, model_path, num_threads, batch_size, window_stride=None, window_aggregation='min'):
+    global _scoring_detector
+    # each worker gets its own intra-op thread budget so that the workers do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+    if artifact_dir is not None:
+        # the memory-mapped artifact lets all workers share one copy of the weights
+        _scoring_detector = GrammarErrorDetector.from_artifact(artifact_dir, batch_size=batch_size, window_stride=window_stride, window_aggregation=window_aggregation)
+    else:
+        _scoring_detector = GrammarErrorDetector(model_path, device='cpu', batch_size=batch_size, window_stride=window_stride, window_aggregation=window_aggregation)
+
+# only the predictions are sent back, the parent process keeps the sentences of the chunks it handed out
+def _score_chunk(sentences):
+    return _scoring_detector.predict(sentences)
+
+# method to score a file with num_workers processes, writing the predictions in input order to a submission CSV
+def score_file_sharded(input_path, output_path, artifact_dir=None, model_path='model.pt', num_workers=None, threads_per_worker=None,
+                       batch_size=32, chunk_size=2000, column='input', window_stride=None, window_aggregation='min'):
+    num_workers = num_workers or os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // num_workers)
+
+    # chunks are handed out to whichever worker is free, and imap returns them in input order
+    context = multiprocessing.get_context('fork')
+    num_sentences = 0
+    with context.Pool(num_workers, initializer=_init_scoring_worker, initargs=(artifact_dir, model_path, threads_per_worker, batch_size, window_stride, window_aggregation)) as pool, \
+            open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['', 'input', 'labels'])
+        # the chunks are queued as the pool's feeder thread reads them, in the same order as imap returns the predictions
+        pending = collections.deque()
+
+        def queued_chunks():
+            for sentences in iter_sentence_chunks(input_path, chunk_size=chunk_size, column=column):
+                pending.append(sentences)
+                yield sentences
+
+        for predictions in tqdm(pool.imap(_score_chunk, queued_chunks()), desc="Scoring"):
+            sentences = pending.popleft()
+            writer.writerows(zip(range(num_sentences, num_sentences + len(sentences)), sentences, predictions.tolist()))
+            num_sentences += len(sentences)
+
+    return num_sentences
+
+# method to run score_file_sharded from command-line style arguments
+def batch_scoring_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Score a CSV, XLSX or text file with several worker processes.")
+    parser.add_argument('input_path', help="file of sentences to score")
+    parser.add_argument('output_path', help="submission CSV to write")
+    parser.add_argument('--artifact-dir', default=None, help="inference artifact written by export_inference_artifact")
+    parser.add_argument('--model-path', default='model.pt', help="model state dict, used when no artifact is given")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--threads-per-worker', type=int, default=None, help="intra-op threads per worker (default: cores / workers)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--chunk-size', type=int, default=2000)
+    parser.add_argument('--column', default='input')
+    parser.add_argument('--window-stride', type=int, default=None, help="score long sentences as overlapping windows starting every N tokens (default: truncate)")
+    parser.add_argument('--window-aggregation', choices=('min', 'mean'), default='min')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    num_sentences = score_file_sharded(args.input_path, args.output_path, artifact_dir=args.artifact_dir, model_path=args.model_path,
+                                       num_workers=args.workers, threads_per_worker=args.threads_per_worker,
+                                       batch_size=args.batch_size, chunk_size=args.chunk_size, column=args.column,
+                                       window_stride=args.window_stride, window_aggregation=args.window_aggregation)
+    elapsed = time.perf_counter() - start
+    print(f"Scored {num_sentences} sentences in {elapsed:.1f} s ({num_sentences / elapsed:.1f} sentences/sec)")
+    return num_sentences
+
+"""# Command Line"""
+
+# method to run a ScoringServer from command-line style arguments
+def serving_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Serve /predict, /health, /ready and /metrics over HTTP with micro-batching.")
+    parser.add_argument('--artifact-dir', default=None, help="inference artifact written by export_inference_artifact")
+    parser.add_argument('--model-path', default='model.pt', help="model state dict, used when no artifact is given")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-batch-size', type=int, default=32, help="most sentences coalesced into one model call")
+    parser.add_argument('--max-wait-ms', type=float, default=5, help="longest wait for a micro-batch to fill up")
+    parser.add_argument('--window-stride', type=int, default=None, help="score long sentences as overlapping windows starting every N tokens (default: truncate)")
+    parser.add_argument('--window-aggregation', choices=('min', 'mean'), default='min')
+    args = parser.parse_args(argv)
+
+    if args.artifact_dir is not None:
+        detector = GrammarErrorDetector.from_artifact(args.artifact_dir, batch_size=args.batch_size,
+                                                      window_stride=args.window_stride, window_aggregation=args.window_aggregation)
+    else:
+        detector = GrammarErrorDetector(args.model_path, batch_size=args.batch_size,
+                                        window_stride=args.window_stride, window_aggregation=args.window_aggregation)
+    server = ScoringServer(detector, host=args.host, port=args.port, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    print(f"Serving on http://{args.host}:{args.port}")
+    asyncio.run(server.serve_forever())
+
+# method to run one of the command-line tools: `score` (score_file_sharded) or `serve` (ScoringServer)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    commands = {'score': batch_scoring_cli, 'serve': serving_cli}
+    if not argv or argv[0] not in commands:
+        sys.exit(f"usage: python ged_inference.py {{{','.join(commands)}}} [-h] ...")
+    commands[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main()